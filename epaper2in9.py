@@ -26,9 +26,20 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 
-from micropython import const
-from time import sleep_ms
-import ustruct
+try:
+    from micropython import const, schedule
+except ImportError:
+    # not on the board, see epaper_sim.py
+    def const(value):
+        return value
+
+    def schedule(func, arg):
+        func(arg)
+from ticks import sleep_ms
+try:
+    import ustruct
+except ImportError:
+    import struct as ustruct
 
 # Display resolution
 EPD_WIDTH  = const(128)
@@ -73,6 +84,39 @@ class EPD:
         self.width = EPD_WIDTH
         self.height = EPD_HEIGHT
 
+        # preallocated so that sending commands doesn't allocate
+        self._cmd = bytearray(1)
+        self._params = bytearray(4)
+        params = memoryview(self._params)
+        self._param1 = params[:1]
+        self._param2 = params[:2]
+        self._param4 = params
+
+        # spi transactions (cs low to cs high) and bytes since the last frame was displayed
+        self.transactions = 0
+        self.bytes = 0
+        # the same for everything that went into the last displayed frame
+        self.frame_transactions = 0
+        self.frame_bytes = 0
+
+        # what to call once the busy pin drops, see when_idle()
+        self._on_idle = None
+        # bound once up front because the irq handler shouldn't allocate
+        self._busy_irq_ref = self._busy_irq
+
+        self.invalidate()
+
+    # forget what the controller's registers hold, so the next write of each goes through
+    def invalidate(self):
+        self._lut = None
+        self._entry_mode = -1
+        self._x_start = -1
+        self._x_end = -1
+        self._y_start = -1
+        self._y_end = -1
+        self._x_counter = -1
+        self._y_counter = -1
+
     # 30 bytes (look up tables)
     # original waveshare example
     LUT_FULL_UPDATE    = bytearray(b'\x02\x02\x01\x11\x12\x12\x22\x22\x66\x69\x69\x59\x58\x99\x99\x88\x00\x00\x00\x00\xF8\xB4\x13\x51\x35\x51\x51\x19\x01\x00')
@@ -82,19 +126,27 @@ class EPD:
     #LUT_FULL_UPDATE    = bytearray(b'\x50\xAA\x55\xAA\x11\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\xFF\xFF\x1F\x00\x00\x00\x00\x00\x00\x00')
     #LUT_PARTIAL_UPDATE = bytearray(b'\x10\x18\x18\x08\x18\x18\x08\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x13\x14\x44\x12\x00\x00\x00\x00\x00\x00')
 
+    # the command and its data go out in one transaction, the controller only looks at dc to tell them apart
     def _command(self, command, data=None):
+        self._cmd[0] = command
         self.dc(0)
         self.cs(0)
-        self.spi.write(bytearray([command]))
-        self.cs(1)
+        self.spi.write(self._cmd)
         if data is not None:
-            self._data(data)
+            self.dc(1)
+            self.spi.write(data)
+            self.bytes += len(data)
+        self.cs(1)
+        self.transactions += 1
+        self.bytes += 1
 
     def _data(self, data):
         self.dc(1)
         self.cs(0)
         self.spi.write(data)
         self.cs(1)
+        self.transactions += 1
+        self.bytes += len(data)
 
     def init(self):
         self.reset()
@@ -103,21 +155,59 @@ class EPD:
         self._command(WRITE_VCOM_REGISTER, b'\xA8') # VCOM 7C
         self._command(SET_DUMMY_LINE_PERIOD, b'\x1A') # 4 dummy lines per gate
         self._command(SET_GATE_TIME, b'\x08') # 2us per line
-        self._command(DATA_ENTRY_MODE_SETTING, b'\x03') # X increment Y increment
+        self.set_data_entry_mode(0x03) # X increment Y increment
         self.set_lut(self.LUT_FULL_UPDATE)
 
+    def is_busy(self):
+        return self.busy.value() == BUSY
+
+    # blocking version of when_idle()
     def wait_until_idle(self):
         while self.busy.value() == BUSY:
             sleep_ms(1) # TODO: make this less?
 
+    # call callback(epd) once the controller is idle without blocking in the meantime. only one callback can be pending, a new one replaces the old one
+    def when_idle(self, callback):
+        self._on_idle = callback
+        # arm the irq before checking so that we can't miss the edge
+        self.busy.irq(trigger=self.busy.IRQ_FALLING, handler=self._busy_irq_ref)
+        if self.busy.value() != BUSY:
+            self.busy.irq(handler=None)
+            # the edge might have come in between arming and checking, in which case the irq already took care of it
+            if self._on_idle is callback:
+                self._on_idle = None
+                callback(self)
+
+    def _busy_irq(self, pin):
+        self.busy.irq(handler=None)
+        callback = self._on_idle
+        if callback is None:
+            return
+        self._on_idle = None
+        # get out of interrupt context before doing anything interesting
+        schedule(callback, self)
+
     def reset(self):
         self.rst(0)
         sleep_ms(200)
         self.rst(1)
         sleep_ms(200)
+        self.invalidate()
 
+    # the luts are compared by identity, so pass the same bytearray every time
     def set_lut(self, lut):
+        if lut is self._lut:
+            return
         self._command(WRITE_LUT_REGISTER, lut)
+        self._lut = lut
+
+    def set_data_entry_mode(self, mode):
+        if mode == self._entry_mode:
+            return
+        params = self._param1
+        params[0] = mode
+        self._command(DATA_ENTRY_MODE_SETTING, params)
+        self._entry_mode = mode
 
     def set_slow(self):
         self.set_lut(self.LUT_FULL_UPDATE)
@@ -145,6 +235,9 @@ class EPD:
         self.set_memory_area(x, y, x_end, y_end)
         self.set_memory_pointer(x, y)
         self._command(WRITE_RAM, image)
+        # writing moved the address counters along
+        self._x_counter = -1
+        self._y_counter = -1
 
     # replace the frame memory with the specified color
     """
@@ -165,20 +258,56 @@ class EPD:
         self._command(TERMINATE_FRAME_READ_WRITE)
         #self.wait_until_idle() # TODO: do we need this? can we move it?
 
+        self.frame_transactions = self.transactions
+        self.frame_bytes = self.bytes
+        self.transactions = 0
+        self.bytes = 0
+
+    # start displaying the frame and return straight away. callback(epd) gets called once the refresh is done
+    def display_frame_async(self, callback):
+        self.display_frame()
+        self.when_idle(callback)
+
     # specify the memory area for data R/W
     def set_memory_area(self, x_start, y_start, x_end, y_end):
-        self._command(SET_RAM_X_ADDRESS_START_END_POSITION)
         # x point must be the multiple of 8 or the last 3 bits will be ignored
-        self._data(bytearray([(x_start >> 3) & 0xFF]))
-        self._data(bytearray([(x_end >> 3) & 0xFF]))
-        self._command(SET_RAM_Y_ADDRESS_START_END_POSITION, ustruct.pack("<HH", y_start, y_end))
+        x_start = (x_start >> 3) & 0xFF
+        x_end = (x_end >> 3) & 0xFF
+        if x_start != self._x_start or x_end != self._x_end:
+            params = self._param2
+            params[0] = x_start
+            params[1] = x_end
+            self._command(SET_RAM_X_ADDRESS_START_END_POSITION, params)
+            self._x_start = x_start
+            self._x_end = x_end
+
+        if y_start != self._y_start or y_end != self._y_end:
+            # little endian 16 bit start and end
+            params = self._param4
+            params[0] = y_start & 0xFF
+            params[1] = (y_start >> 8) & 0xFF
+            params[2] = y_end & 0xFF
+            params[3] = (y_end >> 8) & 0xFF
+            self._command(SET_RAM_Y_ADDRESS_START_END_POSITION, params)
+            self._y_start = y_start
+            self._y_end = y_end
 
     # specify the start point for data R/W
     def set_memory_pointer(self, x, y):
-        self._command(SET_RAM_X_ADDRESS_COUNTER)
         # x point must be the multiple of 8 or the last 3 bits will be ignored
-        self._data(bytearray([(x >> 3) & 0xFF]))
-        self._command(SET_RAM_Y_ADDRESS_COUNTER, ustruct.pack("<H", y))
+        x = (x >> 3) & 0xFF
+        if x != self._x_counter:
+            params = self._param1
+            params[0] = x
+            self._command(SET_RAM_X_ADDRESS_COUNTER, params)
+            self._x_counter = x
+
+        if y != self._y_counter:
+            params = self._param2
+            params[0] = y & 0xFF
+            params[1] = (y >> 8) & 0xFF
+            self._command(SET_RAM_Y_ADDRESS_COUNTER, params)
+            self._y_counter = y
         #self.wait_until_idle() # TODO: do we need this? can we move it?
 
     # to wake call reset() or init()
@@ -0,0 +1,143 @@
+import epaper2in9
+from epaper2in9 import *
+from epaper_sim import Panel, make_epd
+
+def make(refresh_reads=3):
+    panel = Panel(refresh_reads)
+    return panel, make_epd(panel)
+
+def test_when_idle_already_idle():
+    panel, epd = make()
+    calls = []
+    epd.when_idle(calls.append)
+    assert calls == [epd]
+    assert panel.busy.handler is None
+
+def test_when_idle_waits_for_the_edge():
+    panel, epd = make(refresh_reads=0)
+    panel.busy_left = 10
+    calls = []
+    epd.when_idle(calls.append)
+    assert calls == []
+    panel.finish()
+    assert calls == [epd]
+    assert panel.busy.handler is None
+
+def test_when_idle_edge_while_arming():
+    panel, epd = make()
+    panel.busy_left = 1
+    calls = []
+    # the line falls on the very read that checks it
+    epd.when_idle(calls.append)
+    assert calls == [epd]
+
+def test_display_frame_async():
+    panel, epd = make(refresh_reads=5)
+    calls = []
+    epd.display_frame_async(calls.append)
+    assert panel.frames == 1
+    assert calls == []
+    while epd.is_busy():
+        pass
+    assert calls == [epd]
+    # nothing left to call
+    panel.busy_left = 1
+    panel.read_busy()
+    assert calls == [epd]
+
+def test_set_frame_memory():
+    panel, epd = make()
+    epd.set_frame_memory(b'\x01\x02\x03\x04', 8, 10, 16, 2)
+    ram = panel.banks[0]
+    assert ram[10 * 16 + 1:10 * 16 + 3] == b'\x01\x02'
+    assert ram[11 * 16 + 1:11 * 16 + 3] == b'\x03\x04'
+
+def sent(panel, action):
+    """
+    Return the commands action() sends.
+    """
+
+    start = len(panel.commands)
+    action()
+    return panel.commands[start:]
+
+WINDOW = [
+    SET_RAM_X_ADDRESS_START_END_POSITION,
+    SET_RAM_Y_ADDRESS_START_END_POSITION,
+    SET_RAM_X_ADDRESS_COUNTER,
+    SET_RAM_Y_ADDRESS_COUNTER,
+]
+
+def test_same_window_again_is_not_resent():
+    panel, epd = make()
+    image = bytes(4)
+    assert sent(panel, lambda: epd.set_frame_memory(image, 8, 10, 16, 2)) == WINDOW + [WRITE_RAM]
+    # writing moves the address counters along, so only they go again
+    assert sent(panel, lambda: epd.set_frame_memory(image, 8, 10, 16, 2)) == WINDOW[2:] + [WRITE_RAM]
+
+def test_changed_window_is_resent():
+    panel, epd = make()
+    image = bytes(4)
+    epd.set_frame_memory(image, 8, 10, 16, 2)
+    assert sent(panel, lambda: epd.set_frame_memory(image, 8, 20, 16, 2)) == WINDOW[1:] + [WRITE_RAM]
+    assert sent(panel, lambda: epd.set_frame_memory(image, 16, 20, 16, 2)) == [
+        SET_RAM_X_ADDRESS_START_END_POSITION,
+        SET_RAM_X_ADDRESS_COUNTER,
+        SET_RAM_Y_ADDRESS_COUNTER,
+        WRITE_RAM,
+    ]
+    assert panel.banks[0][20 * 16 + 2:20 * 16 + 4] == image[:2]
+
+def test_same_lut_again_is_not_resent():
+    panel, epd = make()
+    assert sent(panel, epd.set_fast) == [WRITE_LUT_REGISTER]
+    assert sent(panel, epd.set_fast) == []
+    assert sent(panel, epd.set_slow) == [WRITE_LUT_REGISTER]
+    assert sent(panel, epd.set_slow) == []
+    assert sent(panel, lambda: epd.set_data_entry_mode(0x03)) == [DATA_ENTRY_MODE_SETTING]
+    assert sent(panel, lambda: epd.set_data_entry_mode(0x03)) == []
+
+def test_reset_resends_everything(monkeypatch):
+    monkeypatch.setattr(epaper2in9, 'sleep_ms', lambda ms: None)
+    panel, epd = make()
+    image = bytes(4)
+    epd.set_fast()
+    epd.set_frame_memory(image, 8, 10, 16, 2)
+    # the controller forgets its registers when it gets reset
+    epd.reset()
+    assert sent(panel, epd.set_fast) == [WRITE_LUT_REGISTER]
+    assert sent(panel, lambda: epd.set_frame_memory(image, 8, 10, 16, 2)) == WINDOW + [WRITE_RAM]
+
+def test_init_resends_everything(monkeypatch):
+    monkeypatch.setattr(epaper2in9, 'sleep_ms', lambda ms: None)
+    panel, epd = make()
+    first = sent(panel, epd.init)
+    assert DATA_ENTRY_MODE_SETTING in first
+    assert WRITE_LUT_REGISTER in first
+    assert sent(panel, epd.init) == first
+
+def test_frame_counts():
+    panel, epd = make()
+    epd.set_frame_memory(bytes(8), 8, 10, 16, 4)
+    epd.display_frame()
+    # the window, the pointer, the image and three to display it
+    assert epd.frame_transactions == 8
+    assert epd.frame_bytes == 3 + 5 + 2 + 3 + 9 + 2 + 1 + 1
+    assert epd.transactions == 0
+    assert epd.bytes == 0
+
+    assert len(panel.transactions) == epd.frame_transactions
+    assert sum(len(data) for transaction in panel.transactions for dc, data in transaction) == epd.frame_bytes
+    assert panel.ignored == 0
+
+def test_command_and_params_in_one_transaction():
+    panel, epd = make()
+    epd.set_frame_memory(bytes(8), 8, 10, 16, 4)
+    epd.display_frame()
+    for transaction in panel.transactions:
+        # the command byte first, then everything else is its parameters
+        assert transaction[0][0] == 0
+        assert len(transaction[0][1]) == 1
+        assert all(dc == 1 for dc, data in transaction[1:])
+    assert [transaction[0][1][0] for transaction in panel.transactions] == panel.commands
+    assert panel.transactions[0] == [(0, bytes([SET_RAM_X_ADDRESS_START_END_POSITION])), (1, bytes([1, 2]))]
@@ -0,0 +1,282 @@
+"""
+A pure python stand-in for the e-paper panel's controller at the other end
+of the spi bus (see epaper2in9.py), so that EPD and Screen can be tested on
+Linux. The panel is the spi bus and has the pins EPD wants, make_epd() wires
+one up.
+
+The controller has two RAM banks. Writes go to one of them and displaying a
+frame shows that one and switches to the other. The busy line then stays
+high for refresh_reads reads of it, so a refresh takes as long as whoever
+waits for it keeps checking.
+
+It also stands in for the bits of framebuf and font_5x8 that Screen uses,
+see install().
+"""
+
+import sys
+
+# the controller's RAM is 128 pixels (16 bytes) across and 296 lines down
+WIDTH_BYTES = 16
+HEIGHT = 296
+
+# the commands the panel pays attention to
+SET_RAM_X_ADDRESS_START_END_POSITION = 0x44
+SET_RAM_Y_ADDRESS_START_END_POSITION = 0x45
+SET_RAM_X_ADDRESS_COUNTER = 0x4E
+SET_RAM_Y_ADDRESS_COUNTER = 0x4F
+WRITE_RAM = 0x24
+MASTER_ACTIVATION = 0x20
+
+
+class Pin:
+    """
+    The bits of machine.Pin that EPD uses.
+    """
+
+    IN = 0
+    OUT = 1
+    PULL_UP = 2
+    IRQ_FALLING = 2
+
+    def __init__(self, value=0):
+        self._value = value
+        self.handler = None
+
+    def init(self, mode=None, value=None, pull=None):
+        if value is not None:
+            self._value = value
+
+    def value(self, value=None):
+        if value is None:
+            return self._value
+        self._value = value
+
+    def __call__(self, value=None):
+        return self.value(value)
+
+    def irq(self, trigger=None, handler=None):
+        self.handler = handler
+
+    def fall(self):
+        if self.handler:
+            self.handler(self)
+
+
+class BusyPin(Pin):
+    def __init__(self, panel):
+        super().__init__()
+        self.panel = panel
+
+    def value(self, value=None):
+        return self.panel.read_busy()
+
+
+class SelectPin(Pin):
+    """
+    The chip select line. While it is low the panel listens to the bus.
+    """
+
+    def __init__(self, panel):
+        super().__init__(1)
+        self.panel = panel
+
+    def value(self, value=None):
+        if value is None:
+            return self._value
+        if value == 0 and self._value:
+            self.panel.transactions.append([])
+        self._value = value
+
+
+class Panel:
+    def __init__(self, refresh_reads=3):
+        self.refresh_reads = refresh_reads
+
+        self.cs = SelectPin(self)
+        self.dc = Pin()
+        self.rst = Pin()
+        self.busy = BusyPin(self)
+
+        self.banks = [bytearray(WIDTH_BYTES * HEIGHT), bytearray(WIDTH_BYTES * HEIGHT)]
+        # the one writes go to
+        self.bank = 0
+        # what the panel shows
+        self.displayed = bytearray(WIDTH_BYTES * HEIGHT)
+
+        self.command = None
+        self.params = bytearray()
+        self.x_start = 0
+        self.x_end = WIDTH_BYTES - 1
+        self.y_start = 0
+        self.y_end = HEIGHT - 1
+        self.x_counter = 0
+        self.y_counter = 0
+
+        # reads of the busy line left before the refresh is done
+        self.busy_left = 0
+
+        self.frames = 0
+        self.ram_bytes = 0
+        # every command byte received, in order
+        self.commands = []
+        # what went over the bus while cs was low, as a list of (dc, bytes) per transaction
+        self.transactions = []
+        # writes while cs was high, which the controller doesn't see
+        self.ignored = 0
+
+    def read_busy(self):
+        if not self.busy_left:
+            return 0
+        self.busy_left -= 1
+        if self.busy_left:
+            return 1
+        # it falls while being read, just like it can between two reads on the board
+        self.busy.fall()
+        return 0
+
+    def finish(self):
+        """
+        Finish the refresh in progress right away.
+        """
+
+        if self.busy_left:
+            self.busy_left = 0
+            self.busy.fall()
+
+    # the panel is the spi bus too
+    def write(self, data):
+        if self.cs.value():
+            self.ignored += 1
+            return
+        self.transactions[-1].append((self.dc.value(), bytes(data)))
+
+        if self.dc.value() == 0:
+            for byte in data:
+                self.start_command(byte)
+        elif self.command == WRITE_RAM:
+            self.write_ram(data)
+        else:
+            self.params.extend(data)
+            self.set_register()
+
+    def start_command(self, command):
+        self.command = command
+        self.params = bytearray()
+        self.commands.append(command)
+        if command == MASTER_ACTIVATION:
+            self.displayed[:] = self.banks[self.bank]
+            self.bank ^= 1
+            self.frames += 1
+            self.busy_left = self.refresh_reads
+
+    def set_register(self):
+        command = self.command
+        params = self.params
+        if command == SET_RAM_X_ADDRESS_START_END_POSITION and len(params) == 2:
+            self.x_start = params[0]
+            self.x_end = params[1]
+        elif command == SET_RAM_Y_ADDRESS_START_END_POSITION and len(params) == 4:
+            self.y_start = params[0] | params[1] << 8
+            self.y_end = params[2] | params[3] << 8
+        elif command == SET_RAM_X_ADDRESS_COUNTER and len(params) == 1:
+            self.x_counter = params[0]
+        elif command == SET_RAM_Y_ADDRESS_COUNTER and len(params) == 2:
+            self.y_counter = params[0] | params[1] << 8
+
+    def write_ram(self, data):
+        # x first, wrapping around inside the window
+        ram = self.banks[self.bank]
+        for byte in data:
+            ram[self.y_counter * WIDTH_BYTES + self.x_counter] = byte
+            self.ram_bytes += 1
+            self.x_counter += 1
+            if self.x_counter > self.x_end:
+                self.x_counter = self.x_start
+                self.y_counter += 1
+                if self.y_counter > self.y_end:
+                    self.y_counter = self.y_start
+
+
+def make_epd(panel):
+    from epaper2in9 import EPD
+    return EPD(panel, panel.cs, panel.dc, panel.rst, panel.busy)
+
+
+# framebuf, only MONO_HLSB: rows of bytes with the leftmost pixel in the most significant bit
+MONO_HLSB = 3
+
+class FrameBuffer:
+    def __init__(self, buf, width, height, format, stride=None):
+        self.buf = buf
+        self.width = width
+        self.height = height
+        self.stride = (width + 7) // 8
+
+    def pixel(self, x, y, colour=None):
+        if x < 0 or y < 0 or x >= self.width or y >= self.height:
+            return None
+        index = y * self.stride + (x >> 3)
+        bit = 0x80 >> (x & 7)
+        if colour is None:
+            return 1 if self.buf[index] & bit else 0
+        if colour:
+            self.buf[index] |= bit
+        else:
+            self.buf[index] &= ~bit & 0xFF
+
+    def fill(self, colour):
+        size = self.stride * self.height
+        self.buf[:size] = (b'\xff' if colour else b'\x00') * size
+
+    def fill_rect(self, x, y, width, height, colour):
+        for py in range(y, y + height):
+            for px in range(x, x + width):
+                self.pixel(px, py, colour)
+
+    def blit(self, source, x, y):
+        if x & 7 or source.width & 7:
+            for sy in range(source.height):
+                for sx in range(source.width):
+                    self.pixel(x + sx, y + sy, source.pixel(sx, sy))
+            return
+
+        # whole bytes line up, so copy a line at a time
+        start = max(0, -y)
+        end = min(source.height, self.height - y)
+        size = min(source.stride, self.stride - (x >> 3))
+        for sy in range(start, end):
+            dest = (y + sy) * self.stride + (x >> 3)
+            src = sy * source.stride
+            self.buf[dest:dest + size] = source.buf[src:src + size]
+
+
+class Font:
+    """
+    font_5x8's font. The glyphs are made up, but each character gets its own.
+    """
+
+    def draw_line(self, line, plot, x=0, y=0):
+        for index, char in enumerate(line):
+            if char == 32:
+                continue
+            bits = char * 2654435761
+            for gx in range(5):
+                for gy in range(7):
+                    if bits >> (gx * 7 + gy) & 1:
+                        plot(x + index * 5 + gx, y + gy)
+
+font = Font()
+
+
+def install():
+    """
+    Stand in for framebuf and font_5x8 unless the real ones can be imported.
+    """
+
+    for name in ('framebuf', 'font_5x8'):
+        if name in sys.modules:
+            continue
+        try:
+            __import__(name)
+        except ImportError:
+            sys.modules[name] = sys.modules[__name__]
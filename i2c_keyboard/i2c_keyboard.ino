@@ -18,15 +18,75 @@
 #define C6 8
 #define C7 9
 
+// pulled low while there are events queued, so the host only has to read when it falls
+#define INT_PIN 10
 
-byte keys[8] = { 0, 0, 0, 0, 0, 0, 0, 0 };
 
-void requestEvent()  
+// protocol version 1: every read gets a frame of up to MAX_EVENTS key
+// events, oldest first. the frame is the version, the number of events and
+// then a (sequence number, key code | KEY_DOWN) pair per event. key codes are
+// row * 8 + column. an event that doesn't fit in the queue still uses up a
+// sequence number so the host can tell something went missing.
+#define PROTOCOL_VERSION 1
+#define MAX_EVENTS 8
+#define FRAME_SIZE (2 + 2 * MAX_EVENTS)
+#define QUEUE_SIZE 64
+#define KEY_DOWN 0x80
+
+// contact bounce makes a key read down and up a few times when it gets
+// pressed or released, which would type it more than once. so a key only
+// goes down or up once it read that way for DEBOUNCE_SCANS scans in a row,
+// and the matrix gets scanned every SCAN_PERIOD ms.
+#define DEBOUNCE_SCANS 5
+#define SCAN_PERIOD 1
+
+// the debounced matrix
+byte previous[8] = { 0, 0, 0, 0, 0, 0, 0, 0 };
+// how many scans in a row each key read differently from previous
+byte unstable[64];
+
+byte queue_seq[QUEUE_SIZE];
+byte queue_event[QUEUE_SIZE];
+volatile byte queue_start = 0;
+volatile byte queue_length = 0;
+byte next_seq = 0;
+
+byte frame[FRAME_SIZE];
+
+void enqueue(byte event)
 {
-    Wire.write(keys, 8);
-    for (int i=0; i<8; ++i) {
-        keys[i] = 0;
+    byte seq = next_seq++;
+
+    // requestEvent runs in an interrupt and takes events off the queue
+    noInterrupts();
+    if (queue_length < QUEUE_SIZE) {
+        byte index = (queue_start + queue_length) % QUEUE_SIZE;
+        queue_seq[index] = seq;
+        queue_event[index] = event;
+        ++queue_length;
+        digitalWrite(INT_PIN, LOW);
     }
+    interrupts();
+}
+
+void requestEvent()
+{
+    byte count = queue_length < MAX_EVENTS ? queue_length : MAX_EVENTS;
+
+    frame[0] = PROTOCOL_VERSION;
+    frame[1] = count;
+    for (int i=0; i<count; ++i) {
+        byte index = (queue_start + i) % QUEUE_SIZE;
+        frame[2 + 2*i] = queue_seq[index];
+        frame[3 + 2*i] = queue_event[index];
+    }
+    queue_start = (queue_start + count) % QUEUE_SIZE;
+    queue_length -= count;
+    if (queue_length == 0) {
+        digitalWrite(INT_PIN, HIGH);
+    }
+
+    Wire.write(frame, FRAME_SIZE);
 }
 
 void setup() {
@@ -47,6 +107,9 @@ void setup() {
     pinMode(C5, INPUT);
     pinMode(C6, INPUT);
     pinMode(C7, INPUT);
+
+    pinMode(INT_PIN, OUTPUT);
+    digitalWrite(INT_PIN, HIGH);
   
     Wire.begin();
     Serial.begin(9600);
@@ -65,18 +128,36 @@ void loop() {
         digitalWrite(R6, (r == 6) ? HIGH : LOW);
         digitalWrite(R7, (r == 7) ? HIGH : LOW);
 
-        if (digitalRead(C0) == HIGH) keys[r] |= 1 << 0;
-        if (digitalRead(C1) == HIGH) keys[r] |= 1 << 1;
-        if (digitalRead(C2) == HIGH) keys[r] |= 1 << 2;
-        if (digitalRead(C3) == HIGH) keys[r] |= 1 << 3;
-        if (digitalRead(C4) == HIGH) keys[r] |= 1 << 4;
-        if (digitalRead(C5) == HIGH) keys[r] |= 1 << 5;
-        if (digitalRead(C6) == HIGH) keys[r] |= 1 << 6;
-        if (digitalRead(C7) == HIGH) keys[r] |= 1 << 7;
+        byte row = 0;
+        if (digitalRead(C0) == HIGH) row |= 1 << 0;
+        if (digitalRead(C1) == HIGH) row |= 1 << 1;
+        if (digitalRead(C2) == HIGH) row |= 1 << 2;
+        if (digitalRead(C3) == HIGH) row |= 1 << 3;
+        if (digitalRead(C4) == HIGH) row |= 1 << 4;
+        if (digitalRead(C5) == HIGH) row |= 1 << 5;
+        if (digitalRead(C6) == HIGH) row |= 1 << 6;
+        if (digitalRead(C7) == HIGH) row |= 1 << 7;
+
+        // queue an event for every key that settled down or up
+        byte changed = row ^ previous[r];
+        for (int c=0; c<8; ++c) {
+            byte key = r * 8 + c;
+            if (!(changed & (1 << c))) {
+                unstable[key] = 0;
+                continue;
+            }
+            if (++unstable[key] < DEBOUNCE_SCANS) {
+                continue;
+            }
+            unstable[key] = 0;
+            previous[r] ^= 1 << c;
+            enqueue(key | ((row & (1 << c)) ? KEY_DOWN : 0));
+        }
     }
+    delay(SCAN_PERIOD);
     /*
     for (int r=0; r<8; ++r) {
-        Serial.print(keys[r]);
+        Serial.print(previous[r]);
     }
     Serial.println("");
     delay(1000);
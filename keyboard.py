@@ -1,6 +1,27 @@
 import time
-import uos
-from machine import I2C, Pin
+try:
+    from machine import I2C, Pin
+except ImportError:
+    # not on the board, pass in something that speaks i2c like keyboard_sim.Controller
+    I2C = None
+from latency import READ
+from keyqueue import KeyQueue
+from ticks import ticks_ms, ticks_diff
+
+# the i2c address of the keyboard controller
+ADDRESS = 8
+
+# what the controller sends when asked, see i2c_keyboard/i2c_keyboard.ino
+# version 0 is the 8 byte matrix of every key that was down since the last read
+PROTOCOL_SNAPSHOT = 0
+# version 1 is a frame of up to MAX_EVENTS key events: version, count, then (sequence number, key code | KEY_DOWN) pairs
+PROTOCOL_EVENTS = 1
+MAX_EVENTS = 8
+FRAME_SIZE = 2 + 2 * MAX_EVENTS
+KEY_DOWN = 0x80
+
+# with the controller's interrupt line hooked up the bus only gets read when it signals, or this often (ms) in case an edge got missed
+IDLE_POLL_PERIOD = 500
 #from machine import Pin
 
 #OUT_DATA = 4
@@ -82,24 +103,33 @@ KEYS = [
 ]
 
 NAMED = {
-    'left': 2, # ctrl-b
-    'right': 6, # ctrl-f
-    'up': 16, # ctrl-p
-    'down': 14, # ctrl-n
-    'tab': 9,
-    'space': 32,
-    'backspace': 8,
-    'enter': 13 # 10
-    #'escape': 27 # skip for now as it implies other things
+    'left': b'\x1b[D',
+    'right': b'\x1b[C',
+    'up': b'\x1b[A',
+    'down': b'\x1b[B',
+    'tab': b'\t',
+    'space': b' ',
+    'backspace': b'\x08',
+    'enter': b'\r' # \n
+    #'escape': b'\x1b' # skip for now as it implies other things
 }
 
+# one bit per modifier so the ones that are held fit in an int
+SHIFT = 1
+CTRL = 2
+ALT = 4
+APPLE = 8
+
 MODIFIERS = {
-    'shift': True,
-    'ctrl': True,
-    'alt': True,
-    'apple': True
+    'shift': SHIFT,
+    'ctrl': CTRL,
+    'alt': ALT,
+    'apple': APPLE
 }
 
+# the modifier bit of each key code, 0 for keys that aren't modifiers
+MODIFIER_BITS = bytearray([MODIFIERS[name] if isinstance(name, str) and name in MODIFIERS else 0 for name in KEYS])
+
 CTRLABLE = {
     'a': True,
     'b': True,
@@ -150,59 +180,78 @@ CTRLABLE = {
 #    return byte
 
 
-def ctrlify(chars):
-    transformed = []
-    for char in chars:
-        if char in CTRLABLE:
-            transformed.append(ord(char) - ord('a') + 1)
-        # ignore other characters because we don't support CTRL-whatever yet
-    return transformed
-
-def shiftify(chars, index):
-    transformed = []
-
-    for char in chars:
-        if isinstance(char, str):
-            if len(char) == 1 and char >= 'a' and char <= 'z':
-                # normal letter so uppercase or lowercase
-                transformed.append(char.upper() if index else char)
-            elif char in NAMED:
-                # any special char
-                transformed.append(NAMED[char])
-            # skip others for now
-        else:
+# the keymap tables, see build_keymap()
+PLAIN = 0
+SHIFTED = 1
+CONTROL = 2
+META = 3
+META_SHIFTED = 4
+# for modifier combinations that don't type anything
+NO_OUTPUT = -1
+
+def table_for(modifiers):
+    # apple doesn't type anything, and neither does ctrl with alt for now
+    if modifiers & APPLE:
+        return NO_OUTPUT
+    if modifiers & ALT:
+        if modifiers & CTRL:
+            return NO_OUTPUT
+        return META_SHIFTED if modifiers & SHIFT else META
+    # ctrl wins over shift
+    if modifiers & CTRL:
+        return CONTROL
+    return SHIFTED if modifiers & SHIFT else PLAIN
+
+# the table for every combination of modifier bits
+TABLE_FOR_MODIFIERS = [table_for(modifiers) for modifiers in range(16)]
+
+def build_keymap():
+    """
+    Work out once what every key types in every table, so that turning a
+    key code into bytes is just KEYMAP[table][code]. b'' means the key
+    doesn't type anything.
+    """
+
+    plain = []
+    shifted = []
+    control = []
+
+    for name in KEYS:
+        if isinstance(name, list):
             # number or punctuation so pick the first or second
-            transformed.append(char[index])
-
-    return transformed
-
-def name_keys(keys):
-    modifiers = {}
-    chars = []
-
-    for key in keys:
-        name = KEYS[key]
-        if name in MODIFIERS:
-            modifiers[name] = True
+            plain.append(name[0].encode())
+            shifted.append(name[1].encode())
+            control.append(b'')
+        elif name in NAMED:
+            # any special key, shift makes no difference
+            plain.append(NAMED[name])
+            shifted.append(NAMED[name])
+            control.append(b'')
+        elif name is not None and len(name) == 1:
+            # normal letter so uppercase or lowercase
+            plain.append(name.encode())
+            shifted.append(name.upper().encode())
+            # ignore other letters because we don't support CTRL-whatever yet
+            control.append(bytes([ord(name) - ord('a') + 1]) if name in CTRLABLE else b'')
         else:
-            chars.append(name)
+            # modifiers, escape and the holes in the matrix
+            plain.append(b'')
+            shifted.append(b'')
+            control.append(b'')
 
-    # alt and apple should just ignore chars for now
-    if 'alt' in modifiers or 'apple' in modifiers:
-        return [modifiers, []]
+    # alt sends escape first like xterm's meta key
+    meta = [b'\x1b' + output if output else b'' for output in plain]
+    meta_shifted = [b'\x1b' + output if output else b'' for output in shifted]
 
-    # ctrl should transform some chars and ignore the rest
-    if 'ctrl' in modifiers:
-        return [modifiers, ctrlify(chars)]
+    return [plain, shifted, control, meta, meta_shifted]
 
-    # shift should transform most chars
-    return [modifiers, shiftify(chars, 1 if 'shift' in modifiers else 0)]
+KEYMAP = build_keymap()
 
 
 prevKeys = None
 
 class Keyboard:
-    def __init__(self):
+    def __init__(self, i2c=None, protocol=PROTOCOL_EVENTS, int_pin=None, on_change=None):
         #self.out_data = Pin(OUT_DATA, Pin.OUT)
         #self.out_clock = Pin(OUT_CLOCK, Pin.OUT)
         #self.out_latch = Pin(OUT_LATCH, Pin.OUT)
@@ -212,17 +261,69 @@ class Keyboard:
         #self.in_data = Pin(IN_DATA, Pin.IN)
         #self.in_enable = Pin(IN_ENABLE, Pin.OUT)
 
-        self.i2c = I2C(scl=Pin(22), sda=Pin(21), freq=100000)
+        if i2c is None:
+            i2c = I2C(scl=Pin(22), sda=Pin(21), freq=100000)
+        self.i2c = i2c
+        # PROTOCOL_SNAPSHOT for controllers that still run the old firmware
+        self.protocol = protocol
 
         self.prev_keys = None
 
-        self.buffered_keys = []
+        # the event protocol reads into this every time
+        self.frame = bytearray(FRAME_SIZE)
+        # the modifier bits of the modifiers that are down according to the events so far
+        self.modifiers = 0
+        # the sequence number the next event should have, None until the first one
+        self.next_seq = None
+        # events that went missing, going by gaps in the sequence numbers
+        self.lost = 0
+
+        # bytes waiting for the repl to read them
+        self.buffered_keys = KeyQueue()
+
+        # a latency.LatencyTracer while tracing
+        self.tracer = None
+
+        # the controller pulls int_pin low while it has events queued. on_change() gets called from the irq so the caller can poll sooner
+        self.int_pin = int_pin
+        self.on_change = on_change
+        # whether the controller signalled since the last read. start off reading once
+        self.changed = True
+        self.last_read = None
+        if int_pin is not None:
+            self.int_irq_ref = self.int_irq
+            int_pin.irq(trigger=int_pin.IRQ_FALLING, handler=self.int_irq_ref)
+
+    def int_irq(self, pin):
+        self.changed = True
+        if self.on_change:
+            self.on_change()
+
+    def poll(self, now=None):
+        if self.int_pin is not None:
+            if now is None:
+                now = ticks_ms()
+            if not self.changed and ticks_diff(now, self.last_read) < IDLE_POLL_PERIOD:
+                return
+            self.changed = False
+            self.last_read = now
+
+        if self.protocol == PROTOCOL_EVENTS:
+            result = self.poll_events()
+        else:
+            result = self.poll_snapshot()
+
+        # the line stays low for as long as there are more events queued than fit in a frame
+        if self.int_pin is not None and self.int_pin.value() == 0:
+            self.changed = True
+
+        return result
 
-    def poll(self):
+    def poll_snapshot(self):
         #start = time.ticks_us()
         keys = []
 
-        numbers = [int(byte) for byte in self.i2c.readfrom(8, 8)]
+        numbers = [int(byte) for byte in self.i2c.readfrom(ADDRESS, 8)]
         for i in range(8):
             number = numbers[i]
             if not number:
@@ -250,23 +351,83 @@ class Keyboard:
         if not len(keys):
             return
 
-        modifiers, names = name_keys(keys)
-        if not len(names):
+        modifiers = 0
+        for key in keys:
+            modifiers |= MODIFIER_BITS[key]
+        table = TABLE_FOR_MODIFIERS[modifiers]
+        if table == NO_OUTPUT:
             return
 
-        for name in names:
-            self.buffered_keys.append(ord(name) if isinstance(name, str) else name)
+        queued = 0
+        for key in keys:
+            output = KEYMAP[table][key]
+            if output:
+                self.buffered_keys.extend(output)
+                queued += len(output)
+        if not queued:
+            return
+
+        if self.tracer:
+            self.tracer.key()
 
         #uos.dupterm_notify(screen) # TODO: dodgy
-        return len(names)
+        return queued
 
         #print(keys, modifiers, names, time.ticks_diff(time.ticks_us(),start))
         # TODO: now push the keys somewhere and return True so we know to notify dupterm?
 
-    def readinto(self, buf):
-        if not len(self.buffered_keys):
-            return None
+    def poll_events(self):
+        """
+        Drain one frame of key events from the controller. Every key down
+        types, so quick presses and repeats between polls don't get lost.
+        Return the number of bytes queued, or None if there were none.
+        """
 
-        buf[0] = self.buffered_keys.pop(0)
-        return 1
+        frame = self.frame
+        self.i2c.readfrom_into(ADDRESS, frame)
+        if frame[0] != PROTOCOL_EVENTS:
+            return
+
+        queued = 0
+        for i in range(min(frame[1], MAX_EVENTS)):
+            seq = frame[2 + 2*i]
+            event = frame[3 + 2*i]
+
+            if self.next_seq is not None and seq != self.next_seq:
+                self.lost += (seq - self.next_seq) & 0xFF
+            self.next_seq = (seq + 1) & 0xFF
+
+            code = event & 0x7F
+            bit = MODIFIER_BITS[code]
+            if bit:
+                if event & KEY_DOWN:
+                    self.modifiers |= bit
+                else:
+                    self.modifiers &= ~bit
+                continue
+            if not event & KEY_DOWN:
+                continue
+
+            # the key that went down along with whatever modifiers are held
+            table = TABLE_FOR_MODIFIERS[self.modifiers]
+            if table == NO_OUTPUT:
+                continue
+            output = KEYMAP[table][code]
+            if not output:
+                continue
+
+            if self.tracer:
+                self.tracer.key()
+
+            self.buffered_keys.extend(output)
+            queued += len(output)
+
+        if queued:
+            return queued
+
+    def readinto(self, buf):
+        count = self.buffered_keys.readinto(buf)
+        if count and self.tracer:
+            self.tracer.mark(READ)
+        return count
 
@@ -0,0 +1,216 @@
+"""
+A pure python stand-in for the keyboard controller at the other end of the
+i2c bus (i2c_keyboard/i2c_keyboard.ino), so that Keyboard can be tested on
+Linux. Pass one in as Keyboard(i2c=Controller()).
+
+Keys only get noticed when the firmware's loop scans the matrix, so press()
+and release() change what is physically down and scan() is one pass of the
+loop. Like the firmware, a key only goes down or up once it read that way
+for debounce_scans scans in a row. press() and release() can make it
+bounce first.
+"""
+
+from keyboard import PROTOCOL_SNAPSHOT, PROTOCOL_EVENTS, MAX_EVENTS, FRAME_SIZE, KEY_DOWN
+
+# how many events the firmware can queue up
+QUEUE_SIZE = 64
+# how many scans in a row a key has to read the same before it counts
+DEBOUNCE_SCANS = 5
+
+
+class IntPin:
+    """
+    The controller's interrupt line as the host's machine.Pin sees it. It is
+    low while there is something to read and calls the irq handler when it
+    falls.
+    """
+
+    IRQ_FALLING = 2
+
+    def __init__(self, controller):
+        self.controller = controller
+        self.handler = None
+
+    def value(self):
+        return 0 if self.controller.has_data() else 1
+
+    def irq(self, trigger=None, handler=None):
+        self.handler = handler
+
+    def fall(self):
+        if self.handler:
+            self.handler(self)
+
+
+class Controller:
+    def __init__(self, protocol=PROTOCOL_EVENTS, queue_size=QUEUE_SIZE, debounce_scans=DEBOUNCE_SCANS):
+        self.protocol = protocol
+        self.queue_size = queue_size
+        self.debounce_scans = debounce_scans
+
+        # what is physically down right now
+        self.matrix = bytearray(8)
+        # key code: scans left before it stops bouncing
+        self.bouncing = {}
+
+        # version 0: every key seen down since the last read
+        self.keys = bytearray(8)
+
+        # version 1: the debounced matrix, how many scans in a row each key read differently from it and the queued (seq, event) pairs
+        self.previous = bytearray(8)
+        self.unstable = bytearray(64)
+        self.queue = []
+        self.next_seq = 0
+        # events that didn't fit in the queue
+        self.dropped = 0
+
+        self.reads = 0
+        self.bytes_read = 0
+
+        self.int_pin = IntPin(self)
+
+    def press(self, code, bounce=0):
+        self.matrix[code >> 3] |= 1 << (code & 7)
+        if bounce:
+            self.bouncing[code] = bounce
+
+    def release(self, code, bounce=0):
+        self.matrix[code >> 3] &= ~(1 << (code & 7)) & 0xFF
+        if bounce:
+            self.bouncing[code] = bounce
+
+    def read_matrix(self):
+        """
+        What a scan reads. A key that bounces flips back and forth for the
+        next few scans before it reads what is physically the case.
+        """
+
+        readings = bytearray(self.matrix)
+        for code in list(self.bouncing):
+            left = self.bouncing[code]
+            if left % 2 == 0:
+                readings[code >> 3] ^= 1 << (code & 7)
+            if left == 1:
+                del self.bouncing[code]
+            else:
+                self.bouncing[code] = left - 1
+        return readings
+
+    def has_data(self):
+        if self.protocol == PROTOCOL_SNAPSHOT:
+            return any(self.keys)
+        return len(self.queue) > 0
+
+    def scan(self):
+        had_data = self.has_data()
+        readings = self.read_matrix()
+
+        for row in range(8):
+            if self.protocol == PROTOCOL_SNAPSHOT:
+                self.keys[row] |= readings[row]
+                continue
+
+            changed = readings[row] ^ self.previous[row]
+            for col in range(8):
+                code = 8*row + col
+                if not changed & (1 << col):
+                    self.unstable[code] = 0
+                    continue
+                self.unstable[code] += 1
+                if self.unstable[code] < self.debounce_scans:
+                    continue
+                self.unstable[code] = 0
+                self.previous[row] ^= 1 << col
+                down = readings[row] & (1 << col)
+                self.enqueue(code | (KEY_DOWN if down else 0))
+
+        if not had_data and self.has_data():
+            self.int_pin.fall()
+
+    def enqueue(self, event):
+        # a dropped event still uses up a sequence number so the host can tell
+        seq = self.next_seq
+        self.next_seq = (seq + 1) & 0xFF
+        if len(self.queue) == self.queue_size:
+            self.dropped += 1
+            return
+        self.queue.append((seq, event))
+
+    def request(self):
+        """
+        What the firmware writes when the host reads.
+        """
+
+        if self.protocol == PROTOCOL_SNAPSHOT:
+            frame = bytes(self.keys)
+            self.keys = bytearray(8)
+            return frame
+
+        count = min(len(self.queue), MAX_EVENTS)
+        frame = bytearray(FRAME_SIZE)
+        frame[0] = PROTOCOL_EVENTS
+        frame[1] = count
+        for i in range(count):
+            frame[2 + 2*i], frame[3 + 2*i] = self.queue[i]
+        del self.queue[:count]
+        return bytes(frame)
+
+    # the bits of machine.I2C that Keyboard uses
+    def readfrom(self, address, nbytes):
+        frame = self.request()[:nbytes]
+        self.reads += 1
+        self.bytes_read += len(frame)
+        return frame
+
+    def readfrom_into(self, address, buf):
+        frame = self.readfrom(address, len(buf))
+        buf[:len(frame)] = frame
+
+
+def settle(controller):
+    """
+    Scan for as long as it takes the keys that changed to count.
+    """
+
+    for scan in range(controller.debounce_scans):
+        controller.scan()
+
+
+def type_keys(controller, keyboard, codes, scans_per_key=None, keys_per_poll=1, bounce=0):
+    """
+    Press and release each key code in turn with the firmware scanning
+    scans_per_key times while it is down and again while it is up, and the
+    host polling after every keys_per_poll keys. By default a key is held
+    for just long enough to count. bounce makes every press and release
+    bounce for that many scans. Return everything the host typed.
+    """
+
+    if scans_per_key is None:
+        scans_per_key = bounce + controller.debounce_scans
+
+    typed = bytearray()
+
+    def poll():
+        keyboard.poll()
+        buf = bytearray(len(keyboard.buffered_keys))
+        if buf:
+            keyboard.readinto(buf)
+            typed.extend(buf)
+
+    for index, code in enumerate(codes):
+        controller.press(code, bounce)
+        for scan in range(scans_per_key):
+            controller.scan()
+        controller.release(code, bounce)
+        for scan in range(scans_per_key):
+            controller.scan()
+
+        if (index + 1) % keys_per_poll == 0:
+            poll()
+
+    # drain whatever is still queued
+    poll()
+    while controller.queue:
+        poll()
+
+    return bytes(typed)
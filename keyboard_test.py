@@ -0,0 +1,195 @@
+from keyboard import *
+from keyboard_sim import Controller, type_keys, settle
+
+def codes(text):
+    return [KEYS.index(char) for char in text]
+
+SHIFT_KEY = KEYS.index('shift')
+CTRL_KEY = KEYS.index('ctrl')
+
+def make(protocol=PROTOCOL_EVENTS, queue_size=64):
+    controller = Controller(protocol, queue_size)
+    return controller, Keyboard(controller, protocol)
+
+def test_events_typing():
+    controller, keyboard = make()
+    assert type_keys(controller, keyboard, codes('hello')) == b'hello'
+    assert keyboard.lost == 0
+
+def test_events_one_read_per_poll():
+    controller, keyboard = make()
+    type_keys(controller, keyboard, codes('hello'))
+    assert controller.reads == 6
+    assert controller.bytes_read == 6 * FRAME_SIZE
+
+def test_events_repeated_key_between_polls():
+    controller, keyboard = make()
+    assert type_keys(controller, keyboard, codes('aaaa'), keys_per_poll=4) == b'aaaa'
+
+def test_snapshot_merges_repeated_key_between_polls():
+    controller, keyboard = make(PROTOCOL_SNAPSHOT)
+    assert type_keys(controller, keyboard, codes('aaaa'), keys_per_poll=4) == b'a'
+
+def test_events_more_than_a_frame_between_polls():
+    controller, keyboard = make()
+    text = 'thequickbrownfox'
+    assert type_keys(controller, keyboard, codes(text), keys_per_poll=len(text)) == text.encode()
+
+def test_events_modifiers():
+    controller, keyboard = make()
+    controller.press(SHIFT_KEY)
+    settle(controller)
+    assert type_keys(controller, keyboard, codes('ab')) == b'AB'
+    controller.release(SHIFT_KEY)
+    controller.press(CTRL_KEY)
+    settle(controller)
+    assert type_keys(controller, keyboard, codes('c')) == b'\x03'
+
+def test_events_lost():
+    controller, keyboard = make(queue_size=4)
+    assert type_keys(controller, keyboard, codes('abcd'), keys_per_poll=4) == b'ab'
+    # 8 events, only 4 fit
+    assert controller.dropped == 4
+    # the gap only shows once the next event makes it
+    assert keyboard.lost == 0
+    assert type_keys(controller, keyboard, codes('e')) == b'e'
+    assert keyboard.lost == 4
+
+def test_events_bounce():
+    controller, keyboard = make()
+    assert type_keys(controller, keyboard, codes('hello'), bounce=3) == b'hello'
+    assert keyboard.lost == 0
+
+def test_events_bounce_without_debouncing():
+    # what the firmware did before it debounced
+    controller = Controller(debounce_scans=1)
+    keyboard = Keyboard(controller)
+    assert type_keys(controller, keyboard, codes('hello'), bounce=3) == b'hhheeellllllooo'
+
+def test_events_short_glitch_is_ignored():
+    controller, keyboard = make()
+    a = KEYS.index('a')
+    controller.press(a)
+    controller.scan()
+    controller.scan()
+    controller.release(a)
+    settle(controller)
+    assert type_keys(controller, keyboard, []) == b''
+    assert controller.next_seq == 0
+
+def test_events_sequence_wraps():
+    controller, keyboard = make()
+    controller.next_seq = 250
+    assert type_keys(controller, keyboard, codes('abcdefgh')) == b'abcdefgh'
+    assert keyboard.lost == 0
+
+def test_lost_key_rate():
+    # a fast typist with several keys between polls
+    text = 'bookkeepermississippi' * 4
+
+    controller, keyboard = make()
+    assert type_keys(controller, keyboard, codes(text), keys_per_poll=3) == text.encode()
+    assert keyboard.lost == 0
+
+    # the old protocol merges repeats and sorts by key code
+    controller, keyboard = make(PROTOCOL_SNAPSHOT)
+    typed = type_keys(controller, keyboard, codes(text), keys_per_poll=3)
+    assert len(typed) < len(text)
+
+def make_interrupt_driven():
+    controller = Controller()
+    calls = []
+    keyboard = Keyboard(controller, int_pin=controller.int_pin, on_change=lambda: calls.append(1))
+    return controller, keyboard, calls
+
+def test_interrupt_driven_idle():
+    controller, keyboard, calls = make_interrupt_driven()
+    # reads once to start with, then leaves the bus alone
+    for now in range(0, 400, 10):
+        keyboard.poll(now)
+    assert controller.reads == 1
+
+def test_interrupt_driven_idle_fallback():
+    controller, keyboard, calls = make_interrupt_driven()
+    for now in range(0, 1010, 10):
+        keyboard.poll(now)
+    assert controller.reads == 1 + 1000 // IDLE_POLL_PERIOD
+
+def test_interrupt_driven_reads_on_change():
+    controller, keyboard, calls = make_interrupt_driven()
+    keyboard.poll(0)
+    controller.press(KEYS.index('a'))
+    settle(controller)
+    assert calls == [1]
+    keyboard.poll(10)
+    assert controller.reads == 2
+    buf = bytearray(4)
+    assert keyboard.readinto(buf) == 1
+    assert buf[:1] == b'a'
+
+def test_interrupt_driven_keeps_reading_while_queued():
+    controller, keyboard, calls = make_interrupt_driven()
+    keyboard.poll(0)
+    text = 'thequickbrownfox'
+    for code in codes(text):
+        controller.press(code)
+        settle(controller)
+        controller.release(code)
+        settle(controller)
+    # only one edge, but the line stays low until the queue is drained
+    assert calls == [1]
+    for now in range(10, 100, 10):
+        keyboard.poll(now)
+    assert len(keyboard.buffered_keys) == len(text)
+    assert controller.reads == 1 + 4
+
+def test_keymap():
+    a = KEYS.index('a')
+    one = KEYS.index(['1', '!'])
+    up = KEYS.index('up')
+    assert KEYMAP[PLAIN][a] == b'a'
+    assert KEYMAP[SHIFTED][a] == b'A'
+    assert KEYMAP[SHIFTED][one] == b'!'
+    assert KEYMAP[CONTROL][a] == b'\x01'
+    assert KEYMAP[CONTROL][KEYS.index('z')] == b''
+    assert KEYMAP[META][a] == b'\x1ba'
+    assert KEYMAP[META_SHIFTED][one] == b'\x1b!'
+    assert KEYMAP[PLAIN][up] == b'\x1b[A'
+    assert KEYMAP[PLAIN][KEYS.index('shift')] == b''
+    assert KEYMAP[PLAIN][KEYS.index('esc')] == b''
+
+def test_table_for_modifiers():
+    assert TABLE_FOR_MODIFIERS[0] == PLAIN
+    assert TABLE_FOR_MODIFIERS[SHIFT] == SHIFTED
+    assert TABLE_FOR_MODIFIERS[CTRL | SHIFT] == CONTROL
+    assert TABLE_FOR_MODIFIERS[ALT | SHIFT] == META_SHIFTED
+    assert TABLE_FOR_MODIFIERS[APPLE] == NO_OUTPUT
+    assert TABLE_FOR_MODIFIERS[APPLE | SHIFT] == NO_OUTPUT
+
+def hold(controller, modifier):
+    controller.press(KEYS.index(modifier))
+    settle(controller)
+
+def test_events_arrows():
+    controller, keyboard = make()
+    assert type_keys(controller, keyboard, [KEYS.index('left'), KEYS.index('up')]) == b'\x1b[D\x1b[A'
+
+def test_events_alt():
+    controller, keyboard = make()
+    hold(controller, 'alt')
+    assert type_keys(controller, keyboard, codes('b')) == b'\x1bb'
+    hold(controller, 'shift')
+    assert type_keys(controller, keyboard, codes('b')) == b'\x1bB'
+
+def test_events_apple():
+    controller, keyboard = make()
+    hold(controller, 'apple')
+    assert type_keys(controller, keyboard, codes('b')) == b''
+    controller.release(KEYS.index('apple'))
+    settle(controller)
+    assert type_keys(controller, keyboard, codes('b')) == b'b'
+
+def test_snapshot_modifiers():
+    controller, keyboard = make(PROTOCOL_SNAPSHOT)
+    hold(controller, 'shift')
+    assert type_keys(controller, keyboard, codes('a')) == b'A'
@@ -0,0 +1,79 @@
+# what put() does when the queue is full
+DROP_NEWEST = 0 # keep what's queued and lose the new byte
+DROP_OLDEST = 1 # make room by losing the oldest queued byte
+
+
+class KeyQueue:
+    """
+    A fixed capacity ring of input bytes waiting to be read. Nothing gets
+    allocated after construction.
+    """
+
+    def __init__(self, capacity=64, policy=DROP_NEWEST):
+        self.capacity = capacity
+        self.policy = policy
+        self.buf = bytearray(capacity)
+        self.mv = memoryview(self.buf)
+        # where the oldest byte is
+        self.start = 0
+        self.length = 0
+        # number of bytes lost because the queue was full
+        self.overflows = 0
+
+    def __len__(self):
+        return self.length
+
+    def put(self, byte):
+        """
+        Queue a byte. Return whether it fit without losing anything.
+        """
+
+        if self.length == self.capacity:
+            self.overflows += 1
+            if self.policy == DROP_NEWEST:
+                return False
+            self.start = (self.start + 1) % self.capacity
+            self.length -= 1
+            self.buf[(self.start + self.length) % self.capacity] = byte
+            self.length += 1
+            return False
+
+        self.buf[(self.start + self.length) % self.capacity] = byte
+        self.length += 1
+        return True
+
+    def extend(self, data):
+        """
+        Queue every byte of data. Return whether it all fit.
+        """
+
+        fit = True
+        for index in range(len(data)):
+            if not self.put(data[index]):
+                fit = False
+        return fit
+
+    def readinto(self, buf):
+        """
+        Move as many queued bytes into buf as fit. Return how many, or None
+        if there was nothing queued like a stream with no data would.
+        """
+
+        if not self.length:
+            return None
+
+        count = min(len(buf), self.length)
+
+        # at most two copies, one up to the end of the ring and one from its start
+        first = min(count, self.capacity - self.start)
+        buf[:first] = self.mv[self.start:self.start + first]
+        if count > first:
+            buf[first:count] = self.mv[:count - first]
+
+        self.start = (self.start + count) % self.capacity
+        self.length -= count
+        return count
+
+    def clear(self):
+        self.start = 0
+        self.length = 0
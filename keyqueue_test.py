@@ -0,0 +1,61 @@
+from keyqueue import *
+
+def put_all(queue, data):
+    for byte in data:
+        queue.put(byte)
+
+def test_empty():
+    q = KeyQueue(4)
+    assert len(q) == 0
+    assert q.readinto(bytearray(4)) is None
+
+def test_reads_as_much_as_fits():
+    q = KeyQueue(8)
+    put_all(q, b'hello')
+    buf = bytearray(3)
+    assert q.readinto(buf) == 3
+    assert buf == b'hel'
+    buf = bytearray(8)
+    assert q.readinto(buf) == 2
+    assert buf[:2] == b'lo'
+    assert len(q) == 0
+
+def test_wraps_around():
+    q = KeyQueue(4)
+    put_all(q, b'abc')
+    q.readinto(bytearray(2))
+    put_all(q, b'def')
+    buf = bytearray(4)
+    assert q.readinto(buf) == 4
+    assert buf == b'cdef'
+
+def test_readinto_memoryview():
+    q = KeyQueue(4)
+    put_all(q, b'ab')
+    buf = bytearray(4)
+    assert q.readinto(memoryview(buf)[1:]) == 2
+    assert buf == b'\x00ab\x00'
+
+def test_drop_newest():
+    q = KeyQueue(2)
+    assert q.put(ord('a'))
+    assert q.put(ord('b'))
+    assert not q.put(ord('c'))
+    assert q.overflows == 1
+    buf = bytearray(2)
+    q.readinto(buf)
+    assert buf == b'ab'
+
+def test_drop_oldest():
+    q = KeyQueue(2, DROP_OLDEST)
+    put_all(q, b'abc')
+    assert q.overflows == 1
+    buf = bytearray(2)
+    q.readinto(buf)
+    assert buf == b'bc'
+
+def test_clear():
+    q = KeyQueue(2)
+    put_all(q, b'ab')
+    q.clear()
+    assert q.readinto(bytearray(2)) is None
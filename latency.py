@@ -0,0 +1,120 @@
+from ticks import ticks_us, ticks_diff
+
+# the stages a keystroke goes through on its way to the screen, in order
+KEY = 0 # Keyboard.poll saw it
+READ = 1 # the REPL read it through readinto
+ECHO = 2 # the echo arrived in Terminal.write
+WRITE = 3 # TextBuffer.write is done with it
+SENT = 4 # display_frame got called for the frame it went into
+SHOWN = 5 # the panel is done refreshing
+STAGES = 6
+
+STAGE_NAMES = ['key', 'read', 'echo', 'write', 'sent', 'shown']
+
+
+class LatencyTracer:
+    """
+    Follow keystrokes through to the screen and keep the timestamps of the
+    last capacity of them in a ring.
+
+    A stage gets marked on every trace that is waiting for it, so fast typing
+    that ends up in the same frame finishes together. SENT and SHOWN only go
+    to the traces start_frame() put in the frame, an echo that arrives while
+    a frame is on its way has to wait for the next one. Traces that never
+    get an echo (like a key the REPL ignores) just get overwritten
+    eventually.
+    """
+
+    def __init__(self, capacity=32):
+        self.capacity = capacity
+        self.times = [0] * (capacity * STAGES)
+        # how many stages each trace reached so far
+        self.reached = bytearray(capacity)
+        # whether each trace is in a frame
+        self.framed = bytearray(capacity)
+        # the slot the next trace goes into
+        self.head = 0
+        # how many of the newest traces are still in flight
+        self.open = 0
+
+    def key(self, now=None):
+        if now is None:
+            now = ticks_us()
+
+        slot = self.head
+        self.times[slot * STAGES] = now
+        self.reached[slot] = 1
+        self.framed[slot] = 0
+        self.head = (slot + 1) % self.capacity
+        if self.open < self.capacity:
+            self.open += 1
+
+    def mark(self, stage, now=None):
+        if now is None:
+            now = ticks_us()
+
+        capacity = self.capacity
+        for i in range(self.open):
+            slot = (self.head - 1 - i) % capacity
+            if self.reached[slot] == stage and (stage < SENT or self.framed[slot]):
+                self.times[slot * STAGES + stage] = now
+                self.reached[slot] = stage + 1
+
+        # the oldest ones that are done don't have to be looked at again
+        while self.open and self.reached[(self.head - self.open) % capacity] == STAGES:
+            self.open -= 1
+
+    def start_frame(self):
+        """
+        Put the traces that made it through WRITE in the frame that's about
+        to be built.
+        """
+
+        capacity = self.capacity
+        for i in range(self.open):
+            slot = (self.head - 1 - i) % capacity
+            if self.reached[slot] == SENT:
+                self.framed[slot] = 1
+
+    def clear(self):
+        for slot in range(self.capacity):
+            self.reached[slot] = 0
+            self.framed[slot] = 0
+        self.head = 0
+        self.open = 0
+
+    def traces(self):
+        """
+        Return the finished traces from oldest to newest. Each one is a list
+        of the microseconds each stage took after the previous one.
+        """
+
+        result = []
+        capacity = self.capacity
+        for i in range(capacity):
+            slot = (self.head + i) % capacity
+            if self.reached[slot] != STAGES:
+                continue
+            base = slot * STAGES
+            result.append([ticks_diff(self.times[base + stage], self.times[base + stage - 1]) for stage in range(1, STAGES)])
+        return result
+
+    def dump(self):
+        """
+        Print every finished trace and the min/avg/max of each stage.
+        """
+
+        traces = self.traces()
+        print(' '.join(STAGE_NAMES[1:]) + ' total')
+        for deltas in traces:
+            print(' '.join(str(delta) for delta in deltas) + ' ' + str(sum(deltas)))
+
+        if not traces:
+            return
+
+        for stage in range(STAGES - 1):
+            deltas = [trace[stage] for trace in traces]
+            print('%s: min %d avg %d max %d' % (STAGE_NAMES[stage + 1], min(deltas), sum(deltas) // len(deltas), max(deltas)))
+
+        totals = [sum(trace) for trace in traces]
+        print('total: min %d avg %d max %d' % (min(totals), sum(totals) // len(totals), max(totals)))
@@ -0,0 +1,96 @@
+from latency import *
+
+def trace_key(tracer, start):
+    tracer.key(start)
+    for stage in range(1, STAGES):
+        if stage == SENT:
+            tracer.start_frame()
+        tracer.mark(stage, start + stage * 10)
+
+def test_one_key():
+    t = LatencyTracer(4)
+    trace_key(t, 1000)
+    assert t.traces() == [[10, 10, 10, 10, 10]]
+    assert t.open == 0
+
+def test_unfinished_traces_are_left_out():
+    t = LatencyTracer(4)
+    t.key(0)
+    t.mark(READ, 5)
+    assert t.traces() == []
+    assert t.open == 1
+
+def test_keys_in_the_same_frame():
+    t = LatencyTracer(4)
+    t.key(0)
+    t.mark(READ, 10)
+    t.mark(ECHO, 20)
+    t.mark(WRITE, 30)
+    t.key(40)
+    t.mark(READ, 50)
+    t.mark(ECHO, 60)
+    t.mark(WRITE, 70)
+    t.start_frame()
+    t.mark(SENT, 80)
+    t.mark(SHOWN, 300)
+    assert t.traces() == [
+        [10, 10, 10, 50, 220],
+        [10, 10, 10, 10, 220],
+    ]
+
+def test_echo_after_the_frame_started_waits_for_the_next():
+    t = LatencyTracer(4)
+    t.key(0)
+    t.mark(READ, 10)
+    t.mark(ECHO, 20)
+    t.mark(WRITE, 30)
+    t.start_frame()
+    t.key(40)
+    t.mark(READ, 50)
+    t.mark(ECHO, 60)
+    t.mark(WRITE, 70)
+    t.mark(SENT, 80)
+    t.mark(SHOWN, 300)
+    assert t.traces() == [[10, 10, 10, 50, 220]]
+    t.start_frame()
+    t.mark(SENT, 400)
+    t.mark(SHOWN, 600)
+    assert t.traces() == [
+        [10, 10, 10, 50, 220],
+        [10, 10, 10, 330, 200],
+    ]
+
+def test_stage_only_marks_traces_waiting_for_it():
+    t = LatencyTracer(4)
+    t.key(0)
+    # output that isn't an echo of anything
+    t.mark(ECHO, 5)
+    t.mark(READ, 10)
+    assert t.reached[0] == READ + 1
+
+def test_ring_wraps():
+    t = LatencyTracer(2)
+    for start in [0, 1000, 2000]:
+        trace_key(t, start)
+    assert len(t.traces()) == 2
+
+def test_stuck_traces_get_overwritten():
+    t = LatencyTracer(2)
+    t.key(0)
+    t.key(10)
+    t.key(20)
+    assert t.open == 2
+
+def test_clear():
+    t = LatencyTracer(2)
+    trace_key(t, 0)
+    t.clear()
+    assert t.traces() == []
+
+def test_dump(capsys):
+    t = LatencyTracer(2)
+    t.dump()
+    trace_key(t, 0)
+    t.dump()
+    out = capsys.readouterr().out
+    assert 'total: min 50 avg 50 max 50' in out
@@ -0,0 +1,107 @@
+# the repl's paste mode: ctrl-e starts it and ctrl-d runs what was pasted
+PASTE_MODE_START = b'\x05'
+PASTE_MODE_END = b'\x04'
+
+# how much of a file gets read at a time
+CHUNK_SIZE = 256
+
+CR = 13
+
+
+class Paste:
+    """
+    Input to hand to the repl instead of keys. source is bytes, a str or a
+    stream with readinto() like an open file. Streams are read a chunk at a
+    time as the input gets pulled through readinto(), so a file never has
+    to fit in memory.
+
+    With paste_mode the input gets wrapped in the repl's paste mode so that
+    multi-line code comes through as typed.
+
+    readinto() stops after every CR, because that is where the repl runs the
+    line and won't read any further for a while.
+    """
+
+    def __init__(self, source, chunk_size=CHUNK_SIZE, paste_mode=False):
+        if isinstance(source, str):
+            source = source.encode()
+
+        if isinstance(source, (bytes, bytearray, memoryview)):
+            self.stream = None
+            self.data = memoryview(source)
+            self.end = len(source)
+        else:
+            self.stream = source
+            self.data = memoryview(bytearray(chunk_size))
+            self.end = 0
+        self.start = 0
+
+        self.prefix = PASTE_MODE_START if paste_mode else b''
+        self.suffix = PASTE_MODE_END if paste_mode else b''
+
+        # bytes and CRs handed out so far
+        self.sent = 0
+        self.lines = 0
+        self.done = False
+
+    def readinto(self, buf):
+        """
+        Fill as much of buf as there is input for, up to and including the
+        next CR. Return how many bytes, or None once there is nothing left.
+        """
+
+        count = 0
+        size = len(buf)
+
+        while count < size:
+            if self.prefix:
+                buf[count] = self.prefix[0]
+                self.prefix = self.prefix[1:]
+                count += 1
+                continue
+
+            if self.start == self.end and self.stream is not None:
+                read = self.stream.readinto(self.data)
+                if read:
+                    self.start = 0
+                    self.end = read
+                    continue
+                # the stream ran out
+                self.close_stream()
+
+            if self.start == self.end:
+                if self.suffix:
+                    buf[count] = self.suffix[0]
+                    self.suffix = self.suffix[1:]
+                    count += 1
+                    continue
+                self.done = True
+                break
+
+            data = self.data
+            start = self.start
+            n = min(self.end - start, size - count)
+            for index in range(start, start + n):
+                if data[index] == CR:
+                    n = index - start + 1
+                    break
+            buf[count:count + n] = data[start:start + n]
+            self.start += n
+            count += n
+            if data[start + n - 1] == CR:
+                self.lines += 1
+                break
+
+        self.sent += count
+        if not count:
+            return None
+        return count
+
+    def close_stream(self):
+        if self.stream is not None and hasattr(self.stream, 'close'):
+            self.stream.close()
+        self.stream = None
+
+    def close(self):
+        self.close_stream()
+        self.done = True
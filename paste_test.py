@@ -0,0 +1,71 @@
+import io
+from paste import *
+
+def read_all(paste, size):
+    result = bytearray()
+    buf = bytearray(size)
+    while True:
+        count = paste.readinto(buf)
+        if count is None:
+            break
+        result.extend(buf[:count])
+    return bytes(result)
+
+def test_bytes():
+    p = Paste(b'print(1)\r')
+    assert read_all(p, 4) == b'print(1)\r'
+    assert p.done
+    assert p.sent == 9
+
+def test_str():
+    assert read_all(Paste('abc'), 1) == b'abc'
+
+def test_empty():
+    p = Paste(b'')
+    assert p.readinto(bytearray(4)) is None
+    assert p.done
+
+def test_paste_mode():
+    assert read_all(Paste(b'x = 1\ny = 2\n', paste_mode=True), 5) == b'\x05x = 1\ny = 2\n\x04'
+
+def test_stream_in_chunks():
+    text = b''.join(b'print(%d)\n' % i for i in range(100))
+    stream = io.BytesIO(text)
+    p = Paste(stream, chunk_size=16)
+    assert len(p.data) == 16
+    assert read_all(p, 7) == text
+
+def test_stream_is_pulled():
+    stream = io.BytesIO(b'a' * 100)
+    p = Paste(stream, chunk_size=16)
+    p.readinto(bytearray(4))
+    # only the first chunk got read
+    assert stream.tell() == 16
+
+def test_stream_paste_mode():
+    p = Paste(io.BytesIO(b'abc'), chunk_size=2, paste_mode=True)
+    assert read_all(p, 1) == b'\x05abc\x04'
+
+def test_close():
+    stream = io.BytesIO(b'abc')
+    p = Paste(stream)
+    p.close()
+    assert stream.closed
+    assert p.done
+    assert p.readinto(bytearray(4)) is None
+
+def test_stops_after_cr():
+    p = Paste(b'a = 1\rb = 2\r')
+    buf = bytearray(64)
+    assert p.readinto(buf) == 6
+    assert buf[:6] == b'a = 1\r'
+    assert p.lines == 1
+    assert p.readinto(buf) == 6
+    assert p.lines == 2
+    assert p.readinto(buf) is None
+
+def test_stream_closed_when_read():
+    stream = io.BytesIO(b'abc')
+    p = Paste(stream, paste_mode=True)
+    read_all(p, 8)
+    assert stream.closed
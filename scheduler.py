@@ -0,0 +1,142 @@
+from ticks import ticks_diff
+
+# why due() last decided to refresh
+QUIET = 'quiet'
+STALE = 'stale'
+
+
+class RefreshScheduler:
+    """
+    Decide when the screen should be refreshed after output was written.
+
+    A refresh waits for the output to go quiet for a bit so that it catches
+    as much as possible in one frame. Isolated small writes like the echo of
+    a keystroke only wait fast_quiet milliseconds. Otherwise the wait scales
+    with what a refresh actually costs, because the more expensive a refresh
+    is, the more it pays to batch. Continuous output never holds the screen
+    back for more than max_stale milliseconds.
+
+    All times are in milliseconds and get passed in, so this doesn't care
+    where they come from.
+    """
+
+    def __init__(self, fast_quiet=20, slow_quiet=300, max_stale=1000, small_write=16, streaming_rate=200, refresh_cost=300):
+        # the tuning knobs
+        self.fast_quiet = fast_quiet
+        self.slow_quiet = slow_quiet
+        self.max_stale = max_stale
+        # writes up to this many bytes at a byte rate (bytes per second) below streaming_rate count as isolated
+        self.small_write = small_write
+        self.streaming_rate = streaming_rate
+
+        # moving averages of what a refresh costs and how fast output is coming in
+        self.refresh_cost = refresh_cost
+        self.byte_rate = 0
+        # the rate gets sampled over at least fast_quiet, this is when the current sample started and what got written since
+        self.sample_start = None
+        self.sample_bytes = 0
+
+        # what has been written since the last refresh started
+        self.first_change = None
+        self.last_change = None
+        self.pending_bytes = 0
+
+        self.refresh_start = None
+
+        # the decisions, for tuning
+        self.last_reason = None
+        self.last_quiet = fast_quiet
+        self.quiet_refreshes = 0
+        self.stale_refreshes = 0
+
+    def wrote(self, nbytes, now):
+        """
+        Record that nbytes got written. Zero is fine for changes that aren't
+        output, it still needs a refresh.
+        """
+
+        if self.last_change is not None and ticks_diff(now, self.last_change) >= self.max_stale:
+            # it went quiet for long enough that the old rate means nothing
+            self.byte_rate = 0
+            self.sample_start = None
+
+        if self.sample_start is None:
+            self.sample_start = now
+            self.sample_bytes = nbytes
+        else:
+            elapsed = ticks_diff(now, self.sample_start)
+            if elapsed >= self.fast_quiet:
+                sample = self.sample_bytes * 1000 // elapsed
+                self.byte_rate += (sample - self.byte_rate) // 4
+                self.sample_start = now
+                self.sample_bytes = nbytes
+            else:
+                # writes that close together count as one, like an echo that comes in two writes
+                self.sample_bytes += nbytes
+
+        if self.first_change is None:
+            self.first_change = now
+        self.last_change = now
+        self.pending_bytes += nbytes
+
+    def quiet_period(self):
+        """
+        How long output has to be quiet before refreshing.
+        """
+
+        if self.pending_bytes <= self.small_write and self.byte_rate < self.streaming_rate:
+            return self.fast_quiet
+
+        return min(max(self.refresh_cost // 2, self.fast_quiet), self.slow_quiet)
+
+    def due(self, now):
+        """
+        Return whether it is time to refresh.
+        """
+
+        if self.first_change is None:
+            return False
+
+        quiet = self.quiet_period()
+        self.last_quiet = quiet
+
+        if ticks_diff(now, self.last_change) >= quiet:
+            self.last_reason = QUIET
+            self.quiet_refreshes += 1
+            return True
+
+        if ticks_diff(now, self.first_change) >= self.max_stale:
+            self.last_reason = STALE
+            self.stale_refreshes += 1
+            return True
+
+        return False
+
+    def requested(self):
+        """
+        Record that a refresh got asked for. It takes care of everything
+        written up to now.
+        """
+
+        self.first_change = None
+        self.pending_bytes = 0
+
+    def started(self, now):
+        """
+        Record that the refresh that got asked for started. That can be a
+        while after asking if the one before it was still going.
+        """
+
+        self.refresh_start = now
+
+    def finished(self, now):
+        """
+        Record that the refresh that started last is done displaying.
+        """
+
+        if self.refresh_start is None:
+            return
+
+        cost = ticks_diff(now, self.refresh_start)
+        self.refresh_cost += (cost - self.refresh_cost) // 4
+        self.refresh_start = None
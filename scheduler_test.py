@@ -0,0 +1,99 @@
+from scheduler import *
+
+def test_nothing_written():
+    s = RefreshScheduler()
+    assert not s.due(0)
+    assert not s.due(10000)
+
+def test_isolated_keystroke_is_fast():
+    s = RefreshScheduler(fast_quiet=20)
+    s.wrote(1, 5000)
+    assert not s.due(5010)
+    assert s.due(5020)
+    assert s.last_reason == QUIET
+    assert s.last_quiet == 20
+
+def test_requested_clears_pending():
+    s = RefreshScheduler()
+    s.wrote(1, 0)
+    assert s.due(100)
+    s.requested()
+    assert not s.due(200)
+    assert s.pending_bytes == 0
+
+def test_big_write_waits_longer():
+    s = RefreshScheduler(fast_quiet=20, slow_quiet=300, refresh_cost=400)
+    s.wrote(100, 0)
+    # half of what a refresh costs
+    assert s.quiet_period() == 200
+    assert not s.due(100)
+    assert s.due(200)
+
+def test_quiet_period_is_capped():
+    s = RefreshScheduler(slow_quiet=300, refresh_cost=2000)
+    s.wrote(100, 0)
+    assert s.quiet_period() == 300
+
+def test_streaming_is_not_isolated():
+    s = RefreshScheduler(fast_quiet=20, streaming_rate=200, refresh_cost=200)
+    # a byte every 2ms is 500 bytes a second
+    for now in range(0, 100, 2):
+        s.wrote(1, now)
+    assert s.byte_rate >= 200
+    s.requested()
+    s.wrote(1, 102)
+    assert s.quiet_period() == 100
+
+def test_rate_resets_after_silence():
+    s = RefreshScheduler(max_stale=1000)
+    for now in range(0, 100, 2):
+        s.wrote(1, now)
+    s.wrote(1, 5000)
+    assert s.byte_rate == 0
+
+def test_continuous_output_is_not_starved():
+    s = RefreshScheduler(max_stale=1000)
+    now = 0
+    while not s.due(now):
+        s.wrote(50, now)
+        now += 10
+    assert now == 1000
+    assert s.last_reason == STALE
+    assert s.stale_refreshes == 1
+
+def test_refresh_cost_is_measured():
+    s = RefreshScheduler(refresh_cost=300)
+    s.wrote(1, 0)
+    s.requested()
+    s.started(0)
+    s.finished(700)
+    assert s.refresh_cost == 400
+    # only once per refresh
+    s.finished(2000)
+    assert s.refresh_cost == 400
+
+def test_echo_in_two_writes_is_isolated():
+    s = RefreshScheduler(fast_quiet=20, streaming_rate=200)
+    # readline's backspace echo, a keystroke every 150ms
+    for now in range(0, 1500, 150):
+        s.wrote(1, now)
+        s.wrote(3, now)
+        assert s.quiet_period() == 20
+        assert s.due(now + 20)
+        s.requested()
+    assert s.byte_rate < 200
+
+def test_refresh_cost_counts_from_the_start():
+    s = RefreshScheduler(refresh_cost=300)
+    s.wrote(1, 0)
+    s.requested()
+    s.started(0)
+    # asked again while the first one is still going
+    s.wrote(1, 100)
+    s.requested()
+    s.finished(300)
+    assert s.refresh_cost == 300
+    # the second one only starts once the first is done
+    s.started(300)
+    s.finished(600)
+    assert s.refresh_cost == 300
@@ -1,9 +1,16 @@
-import time
-from machine import Pin, SPI#, Timer
+try:
+    from machine import Pin, SPI#, Timer
+except ImportError:
+    # not on the board, pass in an epd like epaper_sim.make_epd() returns
+    Pin = None
 from framebuf import FrameBuffer, MONO_HLSB
 from textbuffer import TextBuffer
 from epaper2in9 import EPD
 from font_5x8 import font
+from scheduler import RefreshScheduler
+from stats import Stats
+from latency import WRITE, SENT, SHOWN
+from ticks import ticks_ms, ticks_us, ticks_diff
 
 screen_width = 296
 screen_height = 128
@@ -14,28 +21,93 @@ font_height = 8
 cols = screen_width // font_width
 rows = screen_height // font_height
 
+# the visible ascii chars, which is all a line can contain
+first_glyph = 32
+num_glyphs = 95
+
+WHITE = 0xFF
+BLACK = 0x00
+
+# what the update in progress is busy with, see Screen.step()
+IDLE = 0
+# rendering dirty rows and uploading them to the current buffer
+BUILD = 1
+# waiting for the panel to finish displaying
+REFRESH = 2
+# copying the rows that changed over to the other buffer
+SYNC = 3
+
 
 class Screen:
-    def __init__(self):
+    def __init__(self, epd=None):
 
+        # not lazy: output it skips would never make it into the scrollback
         self.textbuffer = TextBuffer(cols, rows)
 
         # make the framebuffer we draw into the size of one line of text as that's all we need
         self.buf = bytearray(screen_width * font_height // 8)
         # the screen defaults to portrait and we want to use it in landscape so we have to rotate as we go, unfortunately. that's why dimensions look swapped around
         self.fb = FrameBuffer(self.buf, font_height, screen_width, MONO_HLSB)
+        # so we can upload part of the row without copying it
+        self.mv = memoryview(self.buf)
 
-        sck = Pin(18, Pin.OUT)
-        mosi = Pin(23, Pin.OUT)
-        miso = Pin(19, Pin.IN)
-        spi = SPI(2, baudrate=80000000, polarity=0, phase=0, sck=sck, mosi=mosi, miso=miso)
-
-        cs = Pin(5, Pin.OUT)
-        dc = Pin(17, Pin.OUT)
-        rst = Pin(27, Pin.OUT)
-        busy = Pin(35, Pin.IN)
+        self._make_atlas()
+        self.fb.fill(1)
 
-        self.epd = EPD(spi, cs, dc, rst, busy)
+        # what each of the two buffers in the display's controller holds, one row of text after the other in the same layout as self.buf
+        self.shadows = [bytearray(rows * screen_width), bytearray(rows * screen_width)]
+        self.shadow_mvs = [memoryview(shadow) for shadow in self.shadows]
+        # a framebuffer over each row of each shadow so rows can be blitted into a transfer
+        self.row_fbs = [[FrameBuffer(mv[row * screen_width:(row+1) * screen_width], font_height, screen_width, MONO_HLSB) for row in range(rows)] for mv in self.shadow_mvs]
+        # the buffer we're writing to. the controller switches to the other one every time it displays a frame
+        self.bank = 0
+
+        # the window along the screen's y axis that changed in each row and still has to be uploaded. start == end means nothing
+        self.change_start = [0] * rows
+        self.change_end = [0] * rows
+
+        # adjacent rows are next to each other in the controller's memory, so they get uploaded together in one window. the controller wants it x first, so the rows are interleaved
+        self.transfer = bytearray(rows * screen_width)
+        self.transfer_mv = memoryview(self.transfer)
+        # one framebuffer per number of rows in the window, so nothing gets allocated while updating
+        self.transfer_fbs = [FrameBuffer(self.transfer, n * font_height, screen_width, MONO_HLSB) for n in range(1, rows + 1)]
+
+        # the update gets done a slice at a time by step() so it never blocks for long
+        self.state = IDLE
+        self.update_requested = False
+        # dirty rows that still have to be rendered. keys are row indexes, values are (line, start column, end column)
+        self.pending = {}
+        self.cursor_x = 0
+        self.cursor_y = 0
+        # whether anything got uploaded so far, otherwise there's nothing to display
+        self.changed = False
+        # the columns of each row the update in progress touched, so that the other buffer can be synced afterwards
+        self.touched_start = [0] * rows
+        self.touched_end = [0] * rows
+        self.touched_rows = 0
+        self.sync_row = 0
+
+        # timings are in microseconds, see stats()
+        self.perf = Stats(
+            ('pop', 'rasterize', 'upload', 'busy', 'display', 'refresh'),
+            ('fast', 'slow', 'rows', 'bytes', 'lut_switches')
+        )
+        # when the frame being refreshed got sent to the panel
+        self.display_start = 0
+
+        if epd is None:
+            sck = Pin(18, Pin.OUT)
+            mosi = Pin(23, Pin.OUT)
+            miso = Pin(19, Pin.IN)
+            spi = SPI(2, baudrate=80000000, polarity=0, phase=0, sck=sck, mosi=mosi, miso=miso)
+
+            cs = Pin(5, Pin.OUT)
+            dc = Pin(17, Pin.OUT)
+            rst = Pin(27, Pin.OUT)
+            busy = Pin(35, Pin.IN)
+
+            epd = EPD(spi, cs, dc, rst, busy)
+        self.epd = epd
         self.epd.init()
 
         self.clear_screen()
@@ -44,13 +116,22 @@ class Screen:
         self.mode = 'slow'
         self.set_fast()
 
+        # the stats are about updates, not about starting up
+        self.perf.reset()
+
         self.running = False
 
-        self.last_change = None
+        # decides when to draw after things got written
+        self.scheduler = RefreshScheduler()
+
+        # a latency.LatencyTracer while tracing
+        self.tracer = None
 
     def write(self, byteslike):
         self.textbuffer.write(byteslike)
-        self.debounce_update()
+        if self.tracer:
+            self.tracer.mark(WRITE)
+        self.scheduler.wrote(len(byteslike), ticks_ms())
 
     def set_slow(self):
         if self.mode == 'slow':
@@ -58,6 +139,7 @@ class Screen:
 
         self.mode = 'slow'
         self.epd.set_slow()
+        self.perf.count('lut_switches')
 
     def set_fast(self):
         if self.mode == 'fast':
@@ -65,7 +147,9 @@ class Screen:
 
         self.mode = 'fast'
         self.epd.set_fast()
+        self.perf.count('lut_switches')
 
+    # only used to rasterize the glyph atlas
     def plot(self, x, y):
         # rotate 90 degrees on the fly
         self.fb.pixel(font_height - 1 - y, x, 0)
@@ -74,69 +158,361 @@ class Screen:
         # rotate 90 degrees
         self.fb.pixel(font_height - 1 - y, x, 1)
 
-    def debounce_update(self):
-        self.last_change = time.ticks_ms()
+    def _make_atlas(self):
+        """
+        Rasterize every glyph once up front, already rotated. Each glyph is
+        font_width bytes, one per pixel line along the screen's y axis, in
+        the same layout as self.buf. The inverse atlas has the glyphs as
+        they look under the cursor.
+        """
+
+        self.atlas = bytearray(num_glyphs * font_width)
+        self.inverse_atlas = bytearray(num_glyphs * font_width)
+
+        for index in range(num_glyphs):
+            char = bytes((first_glyph + index,))
+            offset = index * font_width
+
+            self.fb.fill(1)
+            font.draw_line(char, self.plot)
+            self.atlas[offset:offset + font_width] = self.buf[:font_width]
+
+            self.fb.fill_rect(0, 0, font_height, font_width, 0)
+            font.draw_line(char, self.plot_inverse, 0, 1)
+            self.inverse_atlas[offset:offset + font_width] = self.buf[:font_width]
+
+    def _render_row(self, line, start, end, cursor_x):
+        """
+        Compose columns start up to end of a row into self.buf by copying
+        glyphs out of the atlas. cursor_x is -1 if the cursor is not on this row.
+        """
+
+        buf = self.buf
+        length = len(line)
+
+        for col in range(start, end):
+            dest = col * font_width
+
+            if col < length:
+                glyph = (line[col] - first_glyph) * font_width
+                atlas = self.inverse_atlas if col == cursor_x else self.atlas
+                for i in range(font_width):
+                    buf[dest + i] = atlas[glyph + i]
+            else:
+                # past the end of the line it is blank, or the cursor block
+                colour = BLACK if col == cursor_x else WHITE
+                for i in range(font_width):
+                    buf[dest + i] = colour
+
+    def start_update(self):
+        """
+        Ask for the dirty rows to be drawn. The work happens in step().
+        """
+
+        self.scheduler.requested()
+        self.update_requested = True
 
     def update_screen(self, tmr=None):
-        self.last_change = None
+        """
+        Draw the dirty rows and block until that's done.
+        """
 
         if not self.running:
             return
 
-        # TODO: keep some performance stats somewhere
+        self.start_update()
+        while self.step():
+            if self.state == REFRESH:
+                start = ticks_us()
+                self.epd.wait_until_idle()
+                self.perf.add_time('busy', ticks_diff(ticks_us(), start))
 
-        # the changed lines. keys are row indexes, values are line strings
-        lines_dict = self.textbuffer.pop()
+    def stats(self):
+        """
+        Return the performance stats gathered since the last reset_stats().
+        Timings are (count, min, avg, max) in microseconds.
+        """
 
-        # slow update if the entire screen changed (gives it a chance to remove the ghosting), otherwise fast for partial updates
-        if len(lines_dict) == self.textbuffer.rows:
-            self.set_slow()
-        else:
-            self.set_fast()
+        return self.perf.snapshot()
 
-        cursor_x = self.textbuffer.x()
-        cursor_y = self.textbuffer.y()
+    def reset_stats(self):
+        self.perf.reset()
 
-        # keep both buffers in the display's controller in sync
-        for i in range(2):
-            self._update_buffer(lines_dict, cursor_x, cursor_y)
+    def is_idle(self):
+        """
+        Return whether there is nothing to draw and nothing waiting to be.
+        """
 
-            # display only one of the buffers
-            if i == 0:
-                self.epd.display_frame()
+        return self.state == IDLE and not self.update_requested and self.scheduler.first_change is None
 
-    def _update_buffer(self, lines_dict, cursor_x, cursor_y):
-        for row_index, line in lines_dict.items():
-            # clear the framebuffer because it now represents this row
-            self.fb.fill(1)
+    def step(self):
+        """
+        Do one bounded slice of the update in progress: render one row,
+        upload one window or check whether the panel is done refreshing.
+        Return whether there is more to do.
+        """
+
+        if not self.running:
+            return False
+
+        state = self.state
+
+        if state == IDLE:
+            if not self.update_requested:
+                return False
+            self.update_requested = False
+            self.state = BUILD
+            self.scheduler.started(ticks_ms())
+            # the frame is whatever is dirty now. rows that get dirty while it is being built wait for the next one, otherwise steady output would keep it from ever being displayed
+            self._absorb()
+
+        elif state == BUILD:
+            if self.pending:
+                row_index, (line, start, end) = self.pending.popitem()
+                self._render_and_stage(row_index, line, start, end)
+            elif self._upload_next_run():
+                self.changed = True
+            else:
+                self._display()
+
+        elif state == REFRESH:
+            if not self.epd.is_busy():
+                # how long the panel took, which is most of what an update costs
+                self.perf.add_time('refresh', ticks_diff(ticks_us(), self.display_start))
+                if self.tracer:
+                    self.tracer.mark(SHOWN)
+                self.state = SYNC
+                self.sync_row = 0
 
-            # print the text
-            font.draw_line(line.encode('ascii'), self.plot)
+        else:
+            # stage the touched rows one at a time, then upload them a window at a time
+            row_index = self.sync_row
+            while row_index < rows and self.touched_end[row_index] <= self.touched_start[row_index]:
+                row_index += 1
+            if row_index < rows:
+                self._sync_row(row_index)
+                self.sync_row = row_index + 1
+            elif not self._upload_next_run():
+                self.state = IDLE
+                self.scheduler.finished(ticks_ms())
+
+        return self.state != IDLE or self.update_requested
+
+    def _absorb(self):
+        """
+        Pull in the rows that got dirty since the last time. A row that is
+        still waiting to be rendered gets the newer line and both spans.
+        """
+
+        textbuffer = self.textbuffer
+        if not textbuffer.is_dirty():
+            return
 
-            if row_index == cursor_y:
-                # draw the cursor (rotated 90 degrees)
-                self.fb.fill_rect(0, cursor_x * font_width, font_height, font_width, 0)
+        pending = self.pending
+        touched_start = self.touched_start
+        touched_end = self.touched_end
+
+        start_us = ticks_us()
+        lines_dict = textbuffer.pop()
+        self.perf.add_time('pop', ticks_diff(ticks_us(), start_us))
+
+        # the echoes that are in there now are the ones this frame shows
+        if self.tracer:
+            self.tracer.start_frame()
+
+        for row_index, (line, start, end) in lines_dict.items():
+            if row_index in pending:
+                old_line, old_start, old_end = pending[row_index]
+                start = min(start, old_start)
+                end = max(end, old_end)
+            pending[row_index] = (line, start, end)
+
+            if touched_end[row_index] <= touched_start[row_index]:
+                touched_start[row_index] = start
+                touched_end[row_index] = end
+                self.touched_rows += 1
+            else:
+                touched_start[row_index] = min(start, touched_start[row_index])
+                touched_end[row_index] = max(end, touched_end[row_index])
+
+        self.cursor_x = textbuffer.x()
+        self.cursor_y = textbuffer.y()
+
+    def _render_and_stage(self, row_index, line, start, end):
+        # the framebuffer now represents the dirty columns of this row, including the cursor if it is on it
+        start_us = ticks_us()
+        self._render_row(line, start, end, self.cursor_x if row_index == self.cursor_y else -1)
+        self.perf.add_time('rasterize', ticks_diff(ticks_us(), start_us))
+
+        # only the dirty columns were rendered. the screen is rotated 90 degrees, so that's a window along the screen's y axis
+        y_start = start * font_width
+        y_end = screen_width if end == self.textbuffer.cols else end * font_width
+
+        self._stage_row(self.mv, 0, row_index, y_start, y_end)
+
+    def _display(self):
+        if not self.changed:
+            # no pixels changed, and the other buffer holds the same as this one, so there is nothing to refresh
+            for row_index in range(rows):
+                self.touched_start[row_index] = 0
+                self.touched_end[row_index] = 0
+            self.touched_rows = 0
+            self.state = IDLE
+            return
 
-                # if the cursor is on a character, also draw that character inverted
-                if cursor_x < len(line):
-                    font.draw_line(line[cursor_x].encode('ascii'), self.plot_inverse, cursor_x*font_width, 1)
+        # slow update if the entire screen changed (gives it a chance to remove the ghosting), otherwise fast for partial updates
+        if self.touched_rows == self.textbuffer.rows:
+            self.set_slow()
+        else:
+            self.set_fast()
 
-            # copy this row to the screen's buffer (rotated 90 degrees)
-            self.epd.set_frame_memory(self.buf, screen_height - ((row_index+1) * font_height), 0, font_height, screen_width)
+        self.perf.count(self.mode)
+
+        # display only one of the buffers
+        start = ticks_us()
+        self.epd.display_frame()
+        self.perf.add_time('display', ticks_diff(ticks_us(), start))
+        self.display_start = start
+        if self.tracer:
+            self.tracer.mark(SENT)
+        self.bank ^= 1
+        self.changed = False
+        self.touched_rows = 0
+        self.state = REFRESH
+
+    def _sync_row(self, row_index):
+        """
+        Bring a row of the current buffer up to date with the one that was
+        just displayed by staging it straight out of that buffer's shadow, so
+        nothing is rendered twice. Only the touched rows can differ.
+        """
+
+        start = self.touched_start[row_index]
+        end = self.touched_end[row_index]
+        self.touched_start[row_index] = 0
+        self.touched_end[row_index] = 0
+
+        y_start = start * font_width
+        y_end = screen_width if end == self.textbuffer.cols else end * font_width
+        self._stage_row(self.shadow_mvs[self.bank ^ 1], row_index * screen_width, row_index, y_start, y_end)
+
+    def _stage_row(self, source, source_base, row_index, y_start, y_end):
+        """
+        Copy the pixels of a row between y_start and y_end that differ from
+        what the current buffer holds into its shadow and remember the window
+        that has to be uploaded. The row's pixels are in source starting at
+        source_base.
+        """
+
+        shadow = self.shadows[self.bank]
+        base = row_index * screen_width
+
+        # narrow the window down to the bytes that differ from the shadow
+        while y_start < y_end and source[source_base + y_start] == shadow[base + y_start]:
+            y_start += 1
+        if y_start == y_end:
+            return
+        while source[source_base + y_end - 1] == shadow[base + y_end - 1]:
+            y_end -= 1
+
+        shadow[base + y_start:base + y_end] = source[source_base + y_start:source_base + y_end]
+
+        # the row might have been staged before and not uploaded yet
+        if self.change_end[row_index] > self.change_start[row_index]:
+            y_start = min(y_start, self.change_start[row_index])
+            y_end = max(y_end, self.change_end[row_index])
+        self.change_start[row_index] = y_start
+        self.change_end[row_index] = y_end
+
+    def _upload_next_run(self):
+        """
+        Upload the next staged run of adjacent changed rows from the current
+        buffer's shadow as one window. Return whether there was one.
+        """
+
+        change_start = self.change_start
+        change_end = self.change_end
+
+        first = 0
+        while first < rows and change_start[first] == change_end[first]:
+            first += 1
+        if first == rows:
+            return False
+
+        # extend the run for as long as the next row changed too, taking the union of the windows
+        y_start = change_start[first]
+        y_end = change_end[first]
+        last = first
+        while last + 1 < rows and change_start[last + 1] != change_end[last + 1]:
+            last += 1
+            y_start = min(y_start, change_start[last])
+            y_end = max(y_end, change_end[last])
+
+        for row_index in range(first, last + 1):
+            change_start[row_index] = 0
+            change_end[row_index] = 0
+
+        self._upload_window(first, last, y_start, y_end)
+        return True
+
+    def _upload_window(self, first, last, y_start, y_end):
+        """
+        Upload rows first to last between y_start and y_end from the current
+        buffer's shadow with one transfer.
+        """
+
+        # set_frame_memory would wait anyway, this way it gets counted separately
+        start = ticks_us()
+        self.epd.wait_until_idle()
+        self.perf.add_time('busy', ticks_diff(ticks_us(), start))
+
+        start = ticks_us()
+        if first == last:
+            # a single row is already laid out the way the controller wants it
+            base = first * screen_width
+            data = self.shadow_mvs[self.bank][base + y_start:base + y_end]
+        else:
+            # the last row is the leftmost one in the controller's memory
+            fb = self.transfer_fbs[last - first]
+            row_fbs = self.row_fbs[self.bank]
+            for row_index in range(first, last + 1):
+                fb.blit(row_fbs[row_index], (last - row_index) * font_height, -y_start)
+            data = self.transfer_mv[:(last - first + 1) * (y_end - y_start)]
+
+        self.epd.set_frame_memory(data, screen_height - ((last+1) * font_height), y_start, (last - first + 1) * font_height, y_end - y_start)
+        self.perf.add_time('upload', ticks_diff(ticks_us(), start))
+        self.perf.count('rows', last - first + 1)
+        self.perf.count('bytes', len(data))
 
     def clear_screen(self):
+        # whatever update was in progress is moot now
+        self.state = IDLE
+        self.pending.clear()
+        self.changed = False
+        for row_index in range(rows):
+            self.change_start[row_index] = 0
+            self.change_end[row_index] = 0
+            self.touched_start[row_index] = 0
+            self.touched_end[row_index] = 0
+        self.touched_rows = 0
+
         self.fb.fill(1)
 
         # clear both buffers
         for i in range(2):
-            for row_index in range(self.textbuffer.rows):
-                self.epd.set_frame_memory(self.buf, row_index * font_height, 0, font_height, screen_width)
+            # the shadow has the same layout as self.buf, just taller
+            shadow = self.shadows[self.bank]
+            FrameBuffer(shadow, font_height, len(shadow), MONO_HLSB).fill(1)
+
+            # the whole screen in one go
+            self._upload_window(0, rows - 1, 0, screen_width)
 
             # but only clear the screen once
             if i == 0:
                 self.epd.display_frame()
+                self.bank ^= 1
 
     def clear(self):
         self.textbuffer.clear()
-        self.debounce_update()
+        self.scheduler.wrote(0, ticks_ms())
 
@@ -0,0 +1,164 @@
+import time
+import epaper_sim
+epaper_sim.install()
+from epaper_sim import Panel, make_epd, WIDTH_BYTES
+from screen import *
+from latency import LatencyTracer, READ, ECHO
+
+def make(refresh_reads=3):
+    panel = Panel(refresh_reads)
+    screen = Screen(make_epd(panel))
+    screen.running = True
+    return panel, screen
+
+def settle(screen):
+    while screen.step():
+        pass
+
+def expected_row(screen, row_index):
+    """
+    Render a row of what the text buffer holds from scratch.
+    """
+
+    lines = screen.textbuffer.get_screen_lines()
+    line = lines[row_index] if row_index < len(lines) else b''
+    cursor_x = screen.textbuffer.x() if row_index == screen.textbuffer.y() else -1
+    screen._render_row(line, 0, cols, cursor_x)
+    return bytes(screen.buf)
+
+def panel_row(ram, row_index):
+    # row r is byte 15 - r of every line of the controller's memory
+    return bytes(ram[y * WIDTH_BYTES + WIDTH_BYTES - 1 - row_index] for y in range(screen_width))
+
+def check_in_sync(panel, screen):
+    assert screen.is_idle()
+    screen.textbuffer.pop()
+    for row_index in range(rows):
+        expected = expected_row(screen, row_index)
+        assert panel_row(panel.displayed, row_index) == expected
+        # both buffers hold the same so the next frame can go to either
+        assert panel_row(panel.banks[0], row_index) == expected
+        assert panel_row(panel.banks[1], row_index) == expected
+        assert screen.shadows[0][row_index * screen_width:(row_index + 1) * screen_width] == expected
+        assert screen.shadows[1][row_index * screen_width:(row_index + 1) * screen_width] == expected
+
+def test_blank_after_init():
+    panel, screen = make()
+    blank = b'\xff' * len(panel.displayed)
+    assert panel.displayed == blank
+    assert panel.banks[0] == blank
+    assert panel.banks[1] == blank
+
+def test_update():
+    panel, screen = make()
+    frames = panel.frames
+    screen.write(b'MicroPython\r\n>>> print(1)\r\n1\r\n>>> ')
+    screen.update_screen()
+    assert panel.frames == frames + 1
+    check_in_sync(panel, screen)
+
+def test_nothing_changed_nothing_displayed():
+    panel, screen = make()
+    screen.write(b'abc')
+    screen.update_screen()
+    frames = panel.frames
+    # overwriting with the same characters leaves every pixel as it was
+    screen.write(b'\x1b[3Dabc')
+    screen.update_screen()
+    assert panel.frames == frames
+    check_in_sync(panel, screen)
+
+def test_edits_in_both_buffers():
+    panel, screen = make()
+    for chunk in [b'>>> ', b'p', b'r', b'i', b'n', b't', b'\x08\x08', b'\x1b[K', b'nt(', b'x' * 70, b'\r\n' * 20, b'abc\x1b[2D']:
+        screen.write(chunk)
+        screen.update_screen()
+        check_in_sync(panel, screen)
+
+def test_continuous_output_still_displays():
+    # a line every poll while the panel takes 30 polls to refresh
+    panel, screen = make(refresh_reads=30)
+    frames = panel.frames
+    for tick in range(300):
+        screen.write(b'line %d\r\n' % tick)
+        screen.start_update()
+        screen.step()
+    assert panel.frames - frames >= 5
+
+    settle(screen)
+    screen.start_update()
+    settle(screen)
+    check_in_sync(panel, screen)
+
+def test_writes_during_every_stage():
+    panel, screen = make(refresh_reads=5)
+    tick = 0
+    for text in [b'first', b'\r\nsecond', b'\x1b[3D', b'X', b'\r\n' * 3, b'more' * 20]:
+        screen.write(text)
+        screen.start_update()
+        for step in range(7):
+            screen.step()
+            tick += 1
+            screen.write(b'%d' % tick)
+    screen.start_update()
+    settle(screen)
+    check_in_sync(panel, screen)
+
+def test_asking_again_keeps_the_refresh_clock():
+    panel, screen = make(refresh_reads=10)
+    screen.write(b'abc')
+    screen.start_update()
+    screen.step()
+    start = screen.scheduler.refresh_start
+    time.sleep(0.002)
+    screen.write(b'd')
+    screen.start_update()
+    assert screen.scheduler.refresh_start == start
+    # the next one starts its clock once the frame before it is done
+    settle(screen)
+    assert screen.scheduler.refresh_start != start
+
+def type_key(screen, char):
+    screen.tracer.key()
+    screen.tracer.mark(READ)
+    screen.tracer.mark(ECHO)
+    screen.write(char)
+
+def test_echo_during_an_update_waits_for_the_next_frame():
+    panel, screen = make(refresh_reads=5)
+    screen.tracer = LatencyTracer(4)
+    frames = panel.frames
+    type_key(screen, b'a')
+    screen.start_update()
+    screen.step()
+    screen.step()
+    # lands while the frame with the first one is being built
+    type_key(screen, b'b')
+    while screen.state != SYNC:
+        screen.step()
+    assert panel.frames == frames + 1
+    assert len(screen.tracer.traces()) == 1
+
+    screen.start_update()
+    settle(screen)
+    assert panel.frames == frames + 2
+    first, second = screen.tracer.traces()
+    # the second key waited for the whole first frame
+    assert second[3] >= first[4]
+
+def test_stats_start_empty():
+    panel, screen = make()
+    for name, value in screen.stats().items():
+        assert value == 0 or value == (0, 0, 0, 0), name
+
+def test_stats_time_the_refresh():
+    panel, screen = make(refresh_reads=20)
+    screen.write(b'abc')
+    screen.start_update()
+    while screen.step():
+        time.sleep(0.0005)
+    stats = screen.stats()
+    assert stats['refresh'][0] == 1
+    # the refresh took longer than sending the command for it
+    assert stats['refresh'][1] > stats['display'][1]
+    assert stats['fast'] == 1
@@ -0,0 +1,67 @@
+class Timing:
+    """
+    Count, min, max and total of a duration in microseconds since the last
+    reset. Adding to it doesn't allocate.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.total = 0
+        self.min = 0
+        self.max = 0
+
+    def add(self, us):
+        if self.count == 0 or us < self.min:
+            self.min = us
+        if us > self.max:
+            self.max = us
+        self.count += 1
+        self.total += us
+
+    def avg(self):
+        if self.count == 0:
+            return 0
+        return self.total // self.count
+
+
+class Stats:
+    """
+    A fixed set of named timings and counters, all created up front.
+    """
+
+    def __init__(self, timings, counters):
+        self.timings = {}
+        for name in timings:
+            self.timings[name] = Timing()
+
+        self.counters = {}
+        for name in counters:
+            self.counters[name] = 0
+
+    def add_time(self, name, us):
+        self.timings[name].add(us)
+
+    def count(self, name, n=1):
+        self.counters[name] += n
+
+    def reset(self):
+        for timing in self.timings.values():
+            timing.reset()
+        for name in self.counters:
+            self.counters[name] = 0
+
+    def snapshot(self):
+        """
+        Return everything as a dict. Timings are (count, min, avg, max) in
+        microseconds.
+        """
+
+        result = {}
+        for name, timing in self.timings.items():
+            result[name] = (timing.count, timing.min, timing.avg(), timing.max)
+        for name, value in self.counters.items():
+            result[name] = value
+        return result
@@ -0,0 +1,38 @@
+import pytest
+from stats import *
+
+def test_timing():
+    t = Timing()
+    assert t.avg() == 0
+    for us in [30, 10, 20]:
+        t.add(us)
+    assert (t.count, t.min, t.avg(), t.max) == (3, 10, 20, 30)
+    t.reset()
+    assert (t.count, t.min, t.avg(), t.max) == (0, 0, 0, 0)
+
+def test_snapshot():
+    s = Stats(('pop', 'display'), ('fast', 'bytes'))
+    s.add_time('pop', 5)
+    s.add_time('pop', 15)
+    s.count('fast')
+    s.count('bytes', 100)
+    assert s.snapshot() == {
+        'pop': (2, 5, 10, 15),
+        'display': (0, 0, 0, 0),
+        'fast': 1,
+        'bytes': 100,
+    }
+
+def test_reset():
+    s = Stats(('pop',), ('fast',))
+    s.add_time('pop', 5)
+    s.count('fast')
+    s.reset()
+    assert s.snapshot() == { 'pop': (0, 0, 0, 0), 'fast': 0 }
+
+def test_unknown_names():
+    s = Stats(('pop',), ('fast',))
+    with pytest.raises(KeyError):
+        s.add_time('display', 5)
+    with pytest.raises(KeyError):
+        s.count('slow')
@@ -1,42 +1,195 @@
 import micropython
-import time
 from uio import IOBase
 import uos
 from keyboard import Keyboard
 from screen import Screen
-from machine import Timer
+from machine import Timer, Pin
+from ticks import ticks_ms, ticks_diff
+from latency import LatencyTracer, ECHO
+from paste import Paste
 
-# don't draw after every single character/chunk we receive. debounce instead
-DEBOUNCE_PERIOD = 300
+# the pin the keyboard controller's interrupt line is on. None polls the keyboard every time instead
+KEYBOARD_INT_PIN = None
+
+# ms between polls while there's something to do
+POLL_PERIOD = 10
+# with the interrupt line there's no need to poll often while the screen has nothing to do either
+IDLE_POLL_PERIOD = 100
+
+# how many pasted bytes can be handed to the repl before it has echoed them. the repl's stdin ring drops what doesn't fit
+PASTE_WINDOW = 128
+# ms without any echo after which the pasted bytes count as taken anyway, for input the repl doesn't echo. only once until the next prompt
+PASTE_STALL = 1000
+# what the repl writes once it's ready for the next line: normal, continuation and paste mode
+PROMPTS = (b'>>> ', b'... ', b'=== ')
 
 class Terminal(IOBase):
-    def __init__(self):
+    def __init__(self, keyboard_int_pin=KEYBOARD_INT_PIN):
         super().__init__()
 
-        self.keyboard = Keyboard()
+        self.poll_ref = self.poll
+        self.schedule_poll_ref = self.schedule_poll
+
+        if keyboard_int_pin is None:
+            self.keyboard = Keyboard()
+        else:
+            # a key poll right away rather than at the next tick
+            self.keyboard = Keyboard(int_pin=Pin(keyboard_int_pin, Pin.IN, Pin.PULL_UP), on_change=self.schedule_poll_ref)
         self.screen = Screen()
 
         self.poller = Timer(-1)
+        self.poll_period = POLL_PERIOD
 
-        self.poll_ref = self.poll
-        self.schedule_poll_ref = self.schedule_poll
         self.screen_write_ref = self.screen.write
 
+        self.tracer = None
+
+        # a paste.Paste while input is being pasted
+        self.paste = None
+        self.paste_quiet = False
+        # how much of the paste the repl has echoed, which is how fast it's taking it
+        self.paste_echoed = 0
+        self.paste_progress = 0
+        # prompts the repl came back with, one per pasted line it's done with
+        self.paste_prompts = 0
+        self.paste_stalled = False
+
+    # the whole buffer goes through so the repl can read everything that's queued in one go
     def readinto(self, buf):
+        # keys wait until the paste is done so they don't end up in the middle of it
+        if self.paste is not None:
+            return self.read_paste(buf)
         return self.keyboard.readinto(buf)
 
     def write(self, byteslike):
+        if self.tracer:
+            self.tracer.mark(ECHO)
         self.screen.write(byteslike)
 
+        if self.paste is not None:
+            # the repl echoes what it reads a character at a time, so count writes rather than bytes. a newline in paste mode comes back as '\r\n=== '
+            self.paste_echoed = min(self.paste.sent, self.paste_echoed + 1)
+            self.paste_progress = ticks_ms()
+            if len(byteslike) >= 4 and bytes(byteslike[-4:]) in PROMPTS:
+                self.paste_prompts = min(self.paste.lines, self.paste_prompts + 1)
+                self.paste_stalled = False
+
+        # there's something to draw now, so stop taking it easy
+        if self.poll_period != POLL_PERIOD:
+            self.arm_poller(POLL_PERIOD)
+
+    def enable_tracing(self, capacity=32):
+        """
+        Start timing keystrokes all the way to the screen. Dump the results
+        with terminal.tracer.dump()
+        """
+
+        self.tracer = LatencyTracer(capacity)
+        self.keyboard.tracer = self.tracer
+        self.screen.tracer = self.tracer
+
+    def disable_tracing(self):
+        self.tracer = None
+        self.keyboard.tracer = None
+        self.screen.tracer = None
+
+    def paste_text(self, text, paste_mode=False, quiet=False):
+        """
+        Type text (bytes or a str) into the repl as if it came from the
+        keyboard. paste_mode wraps it in the repl's paste mode (ctrl-e ...
+        ctrl-d) so that multi-line code keeps its indentation. quiet holds
+        off drawing until the paste is done.
+        """
+
+        self.start_paste(Paste(text, paste_mode=paste_mode), quiet)
+
+    def paste_file(self, path, paste_mode=False, quiet=False):
+        """
+        Like paste_text() but from a file, which gets read a chunk at a time
+        as the repl takes it.
+        """
+
+        self.start_paste(Paste(open(path, 'rb'), paste_mode=paste_mode), quiet)
+
+    def start_paste(self, paste, quiet):
+        if self.paste is not None:
+            self.paste.close()
+        self.paste = paste
+        self.paste_quiet = quiet
+        self.paste_echoed = 0
+        self.paste_progress = ticks_ms()
+        self.paste_prompts = 0
+        self.paste_stalled = False
+        self.arm_poller(POLL_PERIOD)
+
+    def cancel_paste(self):
+        if self.paste is not None:
+            self.finish_paste()
+
+    def finish_paste(self):
+        self.paste.close()
+        self.paste = None
+        if self.paste_quiet:
+            self.paste_quiet = False
+            # draw whatever the paste left behind
+            self.screen.start_update()
+
+    def paste_room(self):
+        """
+        How many more pasted bytes the repl can be handed right now. Nothing
+        after a CR until the prompt is back: the repl is running the line and
+        whatever comes next would pile up in its stdin. A stall lets one more
+        line through.
+        """
+
+        waiting = self.paste.lines - self.paste_prompts
+        if waiting > (1 if self.paste_stalled else 0):
+            return 0
+        return PASTE_WINDOW - (self.paste.sent - self.paste_echoed)
+
+    def read_paste(self, buf):
+        room = self.paste_room()
+        if room <= 0:
+            return None
+        if len(buf) > room:
+            buf = memoryview(buf)[:room]
+
+        count = self.paste.readinto(buf)
+        if count is None and self.paste.done:
+            self.finish_paste()
+        return count
+
     def poll(self, ignore=None):
-        if self.keyboard.poll():
-            uos.dupterm_notify(self)
+        try:
+            now = ticks_ms()
+
+            notify = self.keyboard.poll()
+            if self.paste is not None:
+                if not self.paste_stalled and ticks_diff(now, self.paste_progress) > PASTE_STALL:
+                    self.paste_stalled = True
+                    self.paste_echoed = self.paste.sent
+                # the repl pulls what it has room for through readinto()
+                if self.paste_room() > 0:
+                    notify = True
+            if notify:
+                uos.dupterm_notify(self)
+
+            # don't draw after every single character/chunk we receive, the scheduler decides when
+            if not self.paste_quiet and self.screen.scheduler.due(now):
+                self.screen.start_update()
 
-        if self.screen.last_change:
-            if time.ticks_diff(time.ticks_ms(), self.screen.last_change) > DEBOUNCE_PERIOD:
-                self.screen.update_screen()
+            # only a slice of the update at a time so that keys still get read while the screen refreshes
+            self.screen.step()
+        finally:
+            # whatever went wrong in there, keep polling or the keyboard is dead until a reset
+            if self.keyboard.int_pin is not None and self.screen.is_idle() and self.paste is None:
+                self.arm_poller(IDLE_POLL_PERIOD)
+            else:
+                self.arm_poller(POLL_PERIOD)
 
-        self.poller.init(period=10, mode=Timer.ONE_SHOT, callback=self.schedule_poll_ref)
+    def arm_poller(self, period):
+        self.poll_period = period
+        self.poller.init(period=period, mode=Timer.ONE_SHOT, callback=self.schedule_poll_ref)
 
     def schedule_poll(self, ignore=None):
         micropython.schedule(self.poll_ref, 0)
@@ -45,7 +198,7 @@ class Terminal(IOBase):
         micropython.alloc_emergency_exception_buf(100)
         self.screen.running = True
         uos.dupterm(self)
-        self.poller.init(period=10, mode=Timer.ONE_SHOT, callback=self.schedule_poll_ref)
+        self.arm_poller(POLL_PERIOD)
 
     def uninstall(self):
         self.screen.running = False
@@ -0,0 +1,311 @@
+import sys
+import types
+import pytest
+import epaper_sim
+epaper_sim.install()
+import keyboard
+import screen
+from keyqueue import KeyQueue
+from scheduler import RefreshScheduler
+from textbuffer import TooLongLine
+
+class Timer:
+    ONE_SHOT = 0
+
+    def __init__(self, id):
+        self.period = None
+        self.armed = 0
+
+    def init(self, period=None, mode=None, callback=None):
+        self.period = period
+        self.armed += 1
+
+class IOBase:
+    pass
+
+# who got notified, unless a Repl is listening
+notified = []
+repl = None
+
+def stand_in(name, **attributes):
+    if name not in sys.modules:
+        module = types.ModuleType(name)
+        module.__dict__.update(attributes)
+        sys.modules[name] = module
+
+stand_in('micropython', schedule=lambda func, arg: None, alloc_emergency_exception_buf=lambda size: None)
+stand_in('uio', IOBase=IOBase)
+stand_in('uos', dupterm=lambda stream: None, dupterm_notify=lambda stream: repl.notify() if repl else notified.append(stream))
+stand_in('machine', Timer=Timer, Pin=None)
+
+class FakeKeyboard:
+    def __init__(self, int_pin=None, on_change=None):
+        self.int_pin = int_pin
+        self.tracer = None
+        self.buffered_keys = KeyQueue()
+
+    def poll(self):
+        return len(self.buffered_keys) or None
+
+    def readinto(self, buf):
+        return self.buffered_keys.readinto(buf)
+
+class FakeScreen:
+    def __init__(self):
+        self.scheduler = RefreshScheduler()
+        self.running = False
+        self.tracer = None
+        self.written = bytearray()
+        self.updates = 0
+        # step() raises this if set
+        self.error = None
+
+    def write(self, byteslike):
+        self.written.extend(byteslike)
+        self.scheduler.wrote(len(byteslike), 0)
+
+    def start_update(self):
+        self.scheduler.requested()
+        self.updates += 1
+
+    def step(self):
+        if self.error:
+            raise self.error
+        return False
+
+    def is_idle(self):
+        return True
+
+# terminal.py sets itself up as soon as it is imported, so it has to get the fakes from the start
+real_keyboard, real_screen = keyboard.Keyboard, screen.Screen
+keyboard.Keyboard, screen.Screen = FakeKeyboard, FakeScreen
+try:
+    import terminal
+finally:
+    keyboard.Keyboard, screen.Screen = real_keyboard, real_screen
+
+def make():
+    return terminal.Terminal()
+
+def test_keys_go_through():
+    t = make()
+    t.keyboard.buffered_keys.extend(b'ab')
+    notified.clear()
+    t.poll()
+    assert notified == [t]
+    buf = bytearray(4)
+    assert t.readinto(buf) == 2
+    assert buf[:2] == b'ab'
+
+def test_poll_keeps_polling_after_an_error():
+    t = make()
+    t.screen.error = TooLongLine(b'')
+    armed = t.poller.armed
+    with pytest.raises(TooLongLine):
+        t.poll()
+    assert t.poller.armed == armed + 1
+    assert t.poller.period == terminal.POLL_PERIOD
+
+class Repl:
+    """
+    The repl at the other end of dupterm, as far as pasting goes. Getting
+    notified reads all it can into a stdin ring that drops what doesn't fit.
+    Each tick() takes up to rate bytes out of the ring and echoes them a
+    character at a time. A CR runs the line for run_ticks ticks, printing a
+    line of output each tick, and it reads nothing more until that's done
+    and the prompt is back. Nothing runs in paste mode until ctrl-d.
+    """
+
+    def __init__(self, terminal, rate=16, run_ticks=0, echo=True, ring_size=260):
+        self.terminal = terminal
+        self.rate = rate
+        self.run_ticks = run_ticks
+        self.echo = echo
+        self.ring_size = ring_size
+        self.ring = bytearray()
+        self.dropped = 0
+        self.received = bytearray()
+        self.paste_mode = False
+        self.running = 0
+
+    def notify(self):
+        buf = bytearray(1)
+        while self.terminal.readinto(buf):
+            if len(self.ring) < self.ring_size:
+                self.ring.extend(buf)
+            else:
+                self.dropped += 1
+
+    def run(self):
+        self.running = self.run_ticks
+        if not self.running:
+            self.terminal.write(b'>>> ')
+
+    def tick(self):
+        t = self.terminal
+        if self.running:
+            self.running -= 1
+            t.write(b'output\r\n')
+            if not self.running:
+                t.write(b'>>> ')
+            return
+
+        for i in range(min(self.rate, len(self.ring))):
+            char = self.ring.pop(0)
+            self.received.append(char)
+            if char == 5:
+                self.paste_mode = True
+                t.write(b'\r\npaste mode; Ctrl-C to cancel, Ctrl-D to finish\r\n=== ')
+            elif char == 4:
+                self.paste_mode = False
+                t.write(b'\r\n')
+                self.run()
+                return
+            elif char == 13 and self.paste_mode:
+                t.write(b'\r\n=== ')
+            elif char == 13:
+                t.write(b'\r\n')
+                self.run()
+                return
+            elif self.echo:
+                t.write(bytes([char]))
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [0]
+    monkeypatch.setattr(terminal, 'ticks_ms', lambda: now[0])
+    return now
+
+@pytest.fixture
+def listen():
+    def listen(t, **kwargs):
+        global repl
+        repl = Repl(t, **kwargs)
+        return repl
+    yield listen
+    global repl
+    repl = None
+
+def run(t, clock, ticks=10000):
+    for i in range(ticks):
+        clock[0] += terminal.POLL_PERIOD
+        t.poll()
+        repl.tick()
+        if t.paste is None and not repl.ring and not repl.running:
+            break
+
+LINES = b''.join(b'x%d = %d\r' % (i, i) for i in range(20))
+
+def test_paste_text(clock, listen):
+    t = make()
+    r = listen(t)
+    t.paste_text(LINES)
+    run(t, clock)
+    assert t.paste is None
+    assert r.received == LINES
+    assert r.dropped == 0
+
+def test_paste_is_held_to_the_window(clock, listen):
+    t = make()
+    r = listen(t, rate=0)
+    t.paste_text(b'a' * 1000)
+    t.poll()
+    assert len(r.ring) == terminal.PASTE_WINDOW
+    # nothing comes back, so nothing more goes out
+    t.poll()
+    assert len(r.ring) == terminal.PASTE_WINDOW
+    assert r.dropped == 0
+
+def test_paste_waits_for_the_prompt(clock, listen):
+    t = make()
+    r = listen(t, run_ticks=5)
+    t.paste_text(LINES)
+    for i in range(3):
+        clock[0] += terminal.POLL_PERIOD
+        t.poll()
+        r.tick()
+    # the first line is running and its output doesn't make room for the second
+    assert r.running
+    assert r.received == b'x0 = 0\r'
+    assert not r.ring
+    assert t.paste_room() == 0
+
+    run(t, clock)
+    assert r.received == LINES
+    assert r.dropped == 0
+
+def test_paste_survives_slow_lines(clock, listen):
+    t = make()
+    # every line takes longer than PASTE_STALL without a prompt
+    r = listen(t, run_ticks=terminal.PASTE_STALL // terminal.POLL_PERIOD + 50)
+    text = b''.join(b'x%d = %d\r' % (i, i) for i in range(100))
+    t.paste_text(text)
+    run(t, clock, 100000)
+    assert r.received == text
+    assert r.dropped == 0
+
+def test_stall_frees_the_window_once(clock, listen):
+    t = make()
+    # takes it all but never echoes or prompts, like input() with echo off
+    r = listen(t, rate=1000, echo=False, run_ticks=1000000)
+    t.paste_text(b'a' * 1000)
+    for i in range(1000):
+        clock[0] += terminal.POLL_PERIOD
+        t.poll()
+        r.tick()
+    assert t.paste_stalled
+    assert t.paste.sent == 2 * terminal.PASTE_WINDOW
+    assert r.dropped == 0
+
+def test_paste_file(clock, listen, tmp_path):
+    text = b''.join(b'print(%d)\r' % i for i in range(300))
+    path = tmp_path / 'paste.py'
+    path.write_bytes(text)
+    t = make()
+    r = listen(t, rate=64)
+    t.paste_file(str(path), paste_mode=True)
+    stream = t.paste.stream
+    run(t, clock)
+    assert t.paste is None
+    assert stream.closed
+    assert r.received == b'\x05' + text + b'\x04'
+    assert r.dropped == 0
+
+def test_quiet_paste_draws_at_the_end(clock, listen):
+    t = make()
+    r = listen(t)
+    t.paste_text(LINES, quiet=True)
+    while t.paste is not None:
+        clock[0] += terminal.POLL_PERIOD
+        t.poll()
+        if t.paste is not None:
+            assert t.screen.updates == 0
+        r.tick()
+    assert t.screen.updates == 1
+    assert not t.paste_quiet
+
+def test_loud_paste_draws_along_the_way(clock, listen):
+    t = make()
+    r = listen(t)
+    t.paste_text(LINES)
+    run(t, clock)
+    assert t.screen.updates > 1
+
+def test_keys_wait_for_the_paste(clock, listen):
+    t = make()
+    r = listen(t)
+    t.paste_text(LINES)
+    t.keyboard.buffered_keys.extend(b'ab')
+    run(t, clock)
+    run(t, clock)
+    assert r.received == LINES + b'ab'
+
+def test_cancel_paste(clock, listen):
+    t = make()
+    t.paste_text(b'a' * 1000, quiet=True)
+    t.cancel_paste()
+    assert t.paste is None
+    assert t.screen.updates == 1
+    t.keyboard.buffered_keys.extend(b'b')
+    buf = bytearray(4)
+    assert t.readinto(buf) == 1
@@ -3,13 +3,110 @@ try:
 except:
     import json as ujson
 
-ESCAPE = '\x1b'
-BACKSPACE = '\b'
-CR = '\r'
-LF = '\n'
+ESCAPE = 27
+BACKSPACE = 8
+CR = 13
+LF = 10
+SPACE = b' '
 VT100_SINGLE_CHARS = '=>NODME78Hc'
 VT52_SINGLE_CHARS = '<=>FGABCDHIKJZ'
 MAX_ESCAPE_STRING = 10
+SCROLLBACK = 200 # number of lines kept, including the ones on screen
+LAZY_LIMIT = 4096 # pending output lazy mode holds on to before dropping what can't be seen anymore
+LAZY_MAX = 16384 # pending output lazy mode holds on to before it parses it anyway
+
+# escape parser states
+GROUND = 0
+ESCAPE_STATE = 1 # after ESC
+CSI = 2 # after ESC [
+CHARSET = 3 # after ESC ( or ESC )
+HASH = 4 # after ESC #
+NUMERIC = 5 # after ESC and a digit, like ESC 5 n
+NUM_STATES = 6
+
+# byte classes
+CLASS_OTHER = 0
+CLASS_DIGIT = 1
+CLASS_DIGIT_SINGLE = 2 # digits that are also complete escape sequences on their own
+CLASS_SEPARATOR = 3
+CLASS_LETTER = 4
+CLASS_LETTER_SINGLE = 5 # letters that are also complete escape sequences on their own
+CLASS_PRIVATE = 6
+CLASS_PRIVATE_SINGLE = 7 # private markers that are also complete escape sequences on their own
+CLASS_CSI_START = 8
+CLASS_CHARSET_START = 9
+CLASS_HASH_START = 10
+NUM_CLASSES = 11
+
+# parser actions
+ACTION_UNKNOWN = 0
+ACTION_DIGIT = 1
+ACTION_SEPARATOR = 2
+ACTION_PRIVATE = 3
+ACTION_CSI_DISPATCH = 4
+ACTION_END = 5 # a complete sequence we have no handler for
+ACTION_TO_CSI = 6
+ACTION_TO_CHARSET = 7
+ACTION_TO_HASH = 8
+ACTION_TO_NUMERIC = 9
+
+def make_byte_classes():
+    classes = bytearray(256)
+
+    for dec in range(256):
+        char = chr(dec)
+        if char >= '0' and char <= '9':
+            classes[dec] = CLASS_DIGIT_SINGLE if char in VT100_SINGLE_CHARS else CLASS_DIGIT
+        elif char >= 'A' and char <= 'Z' or char >= 'a' and char <= 'z':
+            classes[dec] = CLASS_LETTER_SINGLE if char in VT100_SINGLE_CHARS else CLASS_LETTER
+        elif char >= '<' and char <= '?':
+            classes[dec] = CLASS_PRIVATE_SINGLE if char in VT100_SINGLE_CHARS else CLASS_PRIVATE
+
+    classes[ord(';')] = CLASS_SEPARATOR
+    classes[ord('[')] = CLASS_CSI_START
+    classes[ord('(')] = CLASS_CHARSET_START
+    classes[ord(')')] = CLASS_CHARSET_START
+    classes[ord('#')] = CLASS_HASH_START
+
+    return classes
+
+def make_transitions():
+    """
+    Return the parser action for each state and byte class, indexed by state * NUM_CLASSES + byte class
+    """
+
+    transitions = bytearray(NUM_STATES * NUM_CLASSES) # ACTION_UNKNOWN unless set below
+
+    def set_actions(state, byte_classes, action):
+        for byte_class in byte_classes:
+            transitions[state * NUM_CLASSES + byte_class] = action
+
+    digits = [CLASS_DIGIT, CLASS_DIGIT_SINGLE]
+    letters = [CLASS_LETTER, CLASS_LETTER_SINGLE]
+
+    set_actions(ESCAPE_STATE, [CLASS_CSI_START], ACTION_TO_CSI)
+    set_actions(ESCAPE_STATE, [CLASS_CHARSET_START], ACTION_TO_CHARSET)
+    set_actions(ESCAPE_STATE, [CLASS_HASH_START], ACTION_TO_HASH)
+    set_actions(ESCAPE_STATE, [CLASS_DIGIT], ACTION_TO_NUMERIC)
+    set_actions(ESCAPE_STATE, [CLASS_DIGIT_SINGLE, CLASS_LETTER_SINGLE, CLASS_PRIVATE_SINGLE], ACTION_END)
+
+    set_actions(CSI, digits, ACTION_DIGIT)
+    set_actions(CSI, [CLASS_SEPARATOR], ACTION_SEPARATOR)
+    set_actions(CSI, [CLASS_PRIVATE, CLASS_PRIVATE_SINGLE], ACTION_PRIVATE)
+    set_actions(CSI, letters, ACTION_CSI_DISPATCH)
+
+    set_actions(CHARSET, digits + letters, ACTION_END)
+
+    set_actions(HASH, range(NUM_CLASSES), ACTION_END)
+
+    set_actions(NUMERIC, digits, ACTION_DIGIT)
+    set_actions(NUMERIC, [CLASS_SEPARATOR], ACTION_SEPARATOR)
+    set_actions(NUMERIC, letters, ACTION_END)
+
+    return transitions
+
+BYTE_CLASSES = make_byte_classes()
+TRANSITIONS = make_transitions()
 
 #def debug(obj):
 #    with open('debug.json', 'wa') as debugfile:
@@ -33,6 +130,9 @@ class OffsetNotFound(Exception):
 class TooLongEscapeString(Exception):
     pass
 
+class CursorMismatch(Exception):
+    pass
+
 def wrap_line(line, cols):
     """
     Return an array of line parts, each no longer than cols
@@ -42,37 +142,29 @@ def wrap_line(line, cols):
 
     # prevent off-by-one if the line length is an exact multiple of cols
     if len(line) % cols == 0:
-        split.append('')
+        split.append(line[:0])
 
     return split
 
-def find_x_in_wrapped_line(offset, wrapped_line, cols):
-    total = 0
-    previous_total = 0
-    for part in wrapped_line:
-        total += len(part)
-        if total >= offset:
-            difference = offset - previous_total
-            # prevent off-by-one if the line length is an exact multiple of cols
-            if difference == cols:
-                return 0
-            else:
-                return difference
-        previous_total = total
+def count_wrapped_rows(length, cols):
+    """
+    Return the number of rows a line of length wraps to
+    """
+
+    # a line that is an exact multiple of cols ends in a blank row for the cursor
+    return length // cols + 1
+
+def find_x_in_wrapped_line(offset, length, cols):
+    # prevent off-by-one if the line length is an exact multiple of cols
+    return offset % cols
 
-def find_y_in_wrapped_line(offset, wrapped_line, cols):
+def find_y_in_wrapped_line(offset, length, cols):
     # it is possible that the line wraps but the cursor is not on the last part of it
-    total = 0
-    for index, part in enumerate(wrapped_line):
-        total += len(part)
-        if total >= offset:
-            # prevent off-by-one if the last line is as long as cols.
-            if total == offset and len(part) == cols:
-                # Cursor should be on the next line which should be blank
-                continue
-            return index
+    if offset > length:
+        raise OffsetNotFound(offset)
 
-    raise OffsetNotFound(offset)
+    # if the offset is at the end of a full row the cursor is on the next (blank) one
+    return offset // cols
 
 def find_number_of_lines_on_screen(wrapped, rows):
     # optimisation for the most common case - you can't have more lines on the screen than the number of lines that will fit
@@ -81,8 +173,8 @@ def find_number_of_lines_on_screen(wrapped, rows):
 
     # slow path: count all the wrapped lines in the scrollback buffer
     total = 0
-    for wrapped_line in wrapped:
-        total += len(wrapped_line)
+    for index in range(len(wrapped)):
+        total += wrapped.count(index)
         # optimisation: stop once we know there are at least as many lines as will fit
         if total >= rows:
             return rows
@@ -92,111 +184,329 @@ def find_number_of_lines_on_screen(wrapped, rows):
 
 def calculate_row(offset, wrapped, cols, rows):
     # we're always in the last line, but not necessarily in the last wrapped part of that
-    last_wrapped = wrapped[-1]
+    last_count = wrapped.count(-1)
 
-    if len(last_wrapped) > rows:
+    if last_count > rows:
         # we don't support lines that wrap so much that it doesn't even fit on the screen
-        raise TooLongLine(last_wrapped)
+        raise TooLongLine(wrapped.lines[-1])
 
-    relative_y = find_y_in_wrapped_line(offset, last_wrapped, cols)
-    from_end = len(last_wrapped) - relative_y
+    relative_y = find_y_in_wrapped_line(offset, len(wrapped.lines[-1]), cols)
+    from_end = last_count - relative_y
 
     number_on_screen = find_number_of_lines_on_screen(wrapped, rows)
 
     return number_on_screen - from_end
 
-def is_letter(char):
-    return char >= 'A' and char <= 'z' or char >= 'a' and char <= 'z'
-
-def is_number(char):
-    return char >= '0' and char <= '9'
-
-def is_escape_end(escape_string):
-    first = escape_string[0]
-    char = escape_string[len(escape_string) - 1]
-
-    if len(escape_string) == 1:
-        return first in VT100_SINGLE_CHARS
-    elif first == '[':
-        return is_letter(char)
-    elif first == '(' or first == ')':
-        return is_letter(char) or is_number(char)
-    elif first == '#':
-        return len(escape_string) == 2
-    elif is_number(first):
-        return is_letter(char)
-    else:
-        # If it didn't start with something that looks like the start of an escape sequence, then we're in uncharted territory.
-        raise UnknownEscapeEnding(escape_string)
+def find_visible_run(text, start):
+    """
+    Return the index just past the run of visible characters starting at start
+    """
+
+    end = start
+    length = len(text)
+    while end < length and text[end] >= 32 and text[end] <= 126:
+        end += 1
+    return end
+
+def find_control(text, start):
+    """
+    Return the index of the first ESC, CR or BS in text from start on, or
+    the length of text if there isn't one. Anything else that isn't visible
+    is an LF or not allowed at all.
+    """
+
+    end = len(text)
+    for char in (b'\x1b', b'\r', b'\x08'):
+        index = text.find(char, start, end)
+        if index != -1:
+            end = index
+    return end
+
+def find_tail(text, rows):
+    """
+    Return the index just past the rows-th last LF in text, or -1 if there
+    aren't that many. Everything before it would scroll off the screen.
+    Takes bytes and only looks at as much of the end as it has to.
+    """
+
+    end = len(text)
+    for found in range(rows):
+        end = text.rfind(b'\n', 0, end)
+        if end == -1:
+            return -1
+    return end + 1
+
+class Scrollback:
+    """
+    A fixed capacity ring of lines. The slots are allocated up front and
+    appending to a full ring evicts the oldest line.
+    """
+
+    def __init__(self, capacity, lines=None):
+        self.capacity = capacity
+        self.slots = [b''] * capacity
+        self.start = 0
+        self.length = 0
+
+        if lines:
+            for line in lines:
+                self.append(line)
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        for index in range(self.length):
+            yield self.slots[(self.start + index) % self.capacity]
+
+    def slot(self, index):
+        if index < 0:
+            index += self.length
+        if index < 0 or index >= self.length:
+            raise IndexError(index)
+        return (self.start + index) % self.capacity
+
+    def __getitem__(self, index):
+        return self.slots[self.slot(index)]
+
+    def __setitem__(self, index, line):
+        self.slots[self.slot(index)] = line
+
+    def append(self, line):
+        if self.length < self.capacity:
+            self.slots[(self.start + self.length) % self.capacity] = line
+            self.length += 1
+        else:
+            self.slots[self.start] = line
+            self.start = (self.start + 1) % self.capacity
+
+    def clear(self):
+        for index in range(self.capacity):
+            self.slots[index] = b''
+        self.start = 0
+        self.length = 0
+
+class WrapView:
+    """
+    The lines as wrapped to rows of cols. Parts are sliced out on demand from
+    the line lengths rather than stored.
+    """
+
+    def __init__(self, lines, cols):
+        self.lines = lines
+        self.cols = cols
+
+    def __len__(self):
+        return len(self.lines)
+
+    def count(self, index):
+        """
+        Return the number of rows the line at index wraps to
+        """
+
+        return count_wrapped_rows(len(self.lines[index]), self.cols)
+
+    def part(self, index, row):
+        """
+        Return the part of the line at index that is on its row'th row
+        """
+
+        start = row * self.cols
+        return self.lines[index][start:start + self.cols]
 
 class Mark:
     def __init__(self, textbuffer):
         self.textbuffer = textbuffer
-        self.before_length = len(textbuffer.wrapped[-1])
+        self.before_x = textbuffer.x()
         self.before_y = textbuffer.y()
+        self.before_start_row = self.before_y - textbuffer.offset // textbuffer.cols
 
-    def apply(self):
-        after_length = len(self.textbuffer.wrapped[-1])
-        if after_length == self.before_length:
-            after_y = self.textbuffer.y()
-            self.textbuffer.dirty.add(self.before_y)
-            self.textbuffer.dirty.add(after_y)
+        # the offsets in the line that changed, empty until touched
+        self.start = 0
+        self.end = 0
+
+    def touch(self, start, end):
+        if self.end <= self.start:
+            self.start = start
+            self.end = end
         else:
-            # this can be optimised so it doesn't redraw the entire screen every time a new line appears, but that will only help in cases where it doesn't scroll yet
-            for y in range(self.textbuffer.rows):
-                self.textbuffer.dirty.add(y)
+            self.start = min(self.start, start)
+            self.end = max(self.end, end)
+
+    def apply(self):
+        textbuffer = self.textbuffer
+        start_row = textbuffer.y() - textbuffer.offset // textbuffer.cols
+
+        if start_row != self.before_start_row:
+            # the line wrapped onto more or fewer rows and that scrolled the whole screen
+            textbuffer.mark_all_dirty()
+            return
+
+        # the cursor is drawn over the text, so where it was and where it is now are both dirty
+        textbuffer.mark_dirty(self.before_y, self.before_x, self.before_x + 1)
+        textbuffer.mark_dirty(textbuffer.y(), textbuffer.x(), textbuffer.x() + 1)
+
+        # if the line wrapped onto more or fewer rows without scrolling, the
+        # changed offsets already cover the rows that appeared or went blank
+        if self.end > self.start:
+            textbuffer.mark_offsets_dirty(self.start, self.end)
 
 class TextBuffer:
-    def __init__(self, cols, rows, lines=None): # 37x16
+    def __init__(self, cols, rows, lines=None, debug=False, scrollback=SCROLLBACK, lazy=False): # 37x16
         self.cols = cols
         self.rows = rows
-        self.lines = lines[:] if lines else []
-        self.wrapped = [] # array of arrays. indexes correspond with lines, array in there contains the wrapped parts
+        # keep at least enough lines to fill the screen
+        self.lines = Scrollback(max(scrollback, rows), lines)
 
         # always at least one
         if len(self.lines) == 0:
-            self.lines.append('')
+            self.lines.append(b'')
 
-        for line in self.lines:
-            self.wrapped.append(wrap_line(line, self.cols))
+        # lines are only ever modified in place so the view stays valid
+        self.wrapped = WrapView(self.lines, self.cols)
 
         # since we're always editing the last line we only have to store the offset into that line. x and y can be calculated from there
         self.offset = 0
-        self.dirty = set() # row numbers that are dirty (including cursor row)
+
+        # dirty column spans per row (including the cursor), from start up to end. empty if end <= start
+        self.dirty_start = [0] * rows
+        self.dirty_end = [0] * rows
 
         self.previous_char = None
-        self.escape_string = None
+
+        # escape parser state. numeric parameters are accumulated in place
+        self.escape_state = GROUND
+        self.escape_length = 0
+        self.escape_private = False
+        self.params = [0] * MAX_ESCAPE_STRING
+        self.param_count = 0
+
+        # CSI handlers by final byte
+        self.csi_handlers = {
+            ord('A'): self.cursor_up,
+            ord('B'): self.cursor_down,
+            ord('C'): self.cursor_forward,
+            ord('D'): self.cursor_back,
+            ord('H'): self.cursor_position,
+            ord('f'): self.cursor_position,
+            ord('J'): self.erase_display,
+            ord('K'): self.erase_line,
+            ord('m'): self.select_graphic_rendition
+        }
+
+        # check the cached cursor position against calculate_row after every change
+        self.debug = debug
+
+        # in lazy mode output is only parsed once pop() needs it, and then
+        # only as much of it as can still end up on the screen. anything
+        # skipped that way never makes it into the scrollback either
+        self.lazy = lazy
+        self.pending = bytearray()
+        self.pending_limit = LAZY_LIMIT
+        # whether output got skipped since the last flush
+        self.skipped = False
+
+        # number of screen rows taken up by the lines before the last one, capped at rows
+        self.rows_above = 0
+        for index in range(len(self.lines) - 1):
+            self.rows_above = min(self.rows, self.rows_above + self.wrapped.count(index))
+
+        self.cursor_x = 0
+        self.cursor_y = 0
+        self.update_cursor()
 
     def x(self):
-        return find_x_in_wrapped_line(self.offset, self.wrapped[-1], self.cols)
+        return self.cursor_x
 
     def y(self):
-        return calculate_row(self.offset, self.wrapped, self.cols, self.rows)
+        return self.cursor_y
+
+    def update_cursor(self):
+        """
+        Recalculate the cached cursor position after the last line or the offset changed
+        """
+
+        count = self.wrapped.count(-1)
+        if count > self.rows:
+            # we don't support lines that wrap so much that it doesn't even fit on the screen
+            raise TooLongLine(self.lines[-1])
+
+        self.cursor_x = self.offset % self.cols
+        self.cursor_y = min(self.rows, self.rows_above + count) - count + self.offset // self.cols
+
+        if self.debug:
+            self.check_cursor()
+
+    def check_cursor(self):
+        x = find_x_in_wrapped_line(self.offset, len(self.lines[-1]), self.cols)
+        y = calculate_row(self.offset, self.wrapped, self.cols, self.rows)
+        if x != self.cursor_x or y != self.cursor_y:
+            raise CursorMismatch((self.cursor_x, self.cursor_y), (x, y))
 
     def line(self):
         return self.lines[-1]
 
     def clear(self):
-        self.lines = []
-        self.wrapped = []
+        self.lines.clear()
         self.offset = 0
+        self.rows_above = 0
+
+        self.lines.append(b'')
+        self.update_cursor()
+
+        self.mark_all_dirty()
+
+    def mark_dirty(self, y, start=0, end=None):
+        """
+        Mark the columns from start up to end of row y dirty. Defaults to the whole row
+        """
 
-        self.lines.append('')
+        if end == None:
+            end = self.cols
+        if y < 0 or y >= self.rows or end <= start:
+            return
 
-        for line in self.lines:
-            self.wrapped.append(wrap_line(line, self.cols))
+        if self.dirty_end[y] <= self.dirty_start[y]:
+            self.dirty_start[y] = start
+            self.dirty_end[y] = end
+        else:
+            if start < self.dirty_start[y]:
+                self.dirty_start[y] = start
+            if end > self.dirty_end[y]:
+                self.dirty_end[y] = end
 
+    def mark_all_dirty(self):
         for y in range(self.rows):
-            self.dirty.add(y)
+            self.dirty_start[y] = 0
+            self.dirty_end[y] = self.cols
+
+    def mark_offsets_dirty(self, start, end):
+        """
+        Mark the parts of the screen covered by offsets start up to end of the line being edited
+        """
+
+        start_row = self.cursor_y - self.offset // self.cols
+        for row in range(start // self.cols, (end - 1) // self.cols + 1):
+            row_offset = row * self.cols
+            self.mark_dirty(start_row + row, max(start - row_offset, 0), min(end - row_offset, self.cols))
 
     def start_change(self):
         return Mark(self)
 
-    def change(self, line, apply_mark=True):
+    def change(self, line, start=0, end=None, apply_mark=True):
+        """
+        Replace the line being edited. start and end are the offsets that
+        changed, by default everything up to the end of the old or new line
+        """
+
         mark = self.start_change()
 
+        if end == None:
+            end = max(len(line), len(self.lines[-1]))
+
         self.lines[-1] = line
-        self.wrapped[-1] = wrap_line(line, self.cols)
+        self.update_cursor()
+        mark.touch(start, end)
 
         if apply_mark:
             mark.apply()
@@ -205,72 +515,288 @@ class TextBuffer:
 
     def write(self, text):
         """
-        parse text, update lines, wrapped and cursor position
+        parse bytes, update lines and cursor position
 
         \b backspace should move the cursor back one
         \x1b[%uD  should move the cursor %u chars left
         \x1b[K clear the line from the cursor right
         \r\n new line (\r x=0, \n y+=1)
+
+        Takes bytes, bytearray or memoryview as handed over by dupterm and
+        works on byte values throughout. A str is encoded once up front.
+
+        Runs of visible characters are spliced into the line in one go rather
+        than one character at a time.
         """
 
-        for char in text:
-            self.write_char(char)
+        if isinstance(text, str):
+            text = text.encode()
+
+        if self.lazy:
+            self.pending.extend(text)
+            if len(self.pending) > self.pending_limit:
+                self.drop_hidden()
+                if len(self.pending) > LAZY_MAX:
+                    self.flush()
+            return
+
+        self.parse(text)
+
+    def drop_hidden(self):
+        """
+        Drop the pending output that would scroll off the screen anyway.
+        """
 
-    def write_char(self, str_or_int):
-        if isinstance(str_or_int, str):
-            char = str_or_int
-            dec = ord(str_or_int)
+        text = bytes(self.pending)
+        tail = find_tail(text, self.rows)
+        if tail != -1:
+            del self.pending[:tail]
+            self.skipped = True
         else:
-            char = chr(str_or_int)
-            dec = str_or_int
+            tail = 0
+
+        # the last line can be too long to fit on the screen by itself. then
+        # the parser cuts whole rows off its start (see handle_overlong_run),
+        # so rows of the plain characters it starts with can go as long as
+        # what's left of them still gets everything before them cut. that
+        # needs the offset and length the line starts out with: blank after a
+        # new line, or the line being edited if it carries on from there
+        start = text.rfind(b'\n') + 1
+        if start or self.skipped:
+            self.drop_overlong(text, start, tail, 0, 0)
+        elif self.escape_state == GROUND:
+            self.drop_overlong(text, start, tail, self.offset, len(self.line()))
+
+        # long lines full of escapes can keep what's left big, so don't look again until it doubled
+        self.pending_limit = min(max(LAZY_LIMIT, 2 * len(self.pending)), LAZY_MAX)
+
+    def drop_overlong(self, text, start, tail, offset, length):
+        """
+        Drop whole rows off the run of plain characters at start, which
+        gets written at offset into a line of length, if the parser would
+        cut them off anyway.
+        """
 
-        if self.escape_string != None:
-            self.escape_string.append(char)
+        cols = self.cols
+        run = find_control(text, start) - start
+        # what the parser would cut off the start of the line after the run
+        cut = ((offset + run) // cols + 1 - self.rows) * cols
+        # keep enough to cut everything that was on the line before too
+        drop = min(cut - offset, offset + run - length) // cols * cols
+        if drop > 0:
+            del self.pending[start - tail:start - tail + drop]
 
-            if len(self.escape_string) > MAX_ESCAPE_STRING:
-                raise TooLongEscapeString(self.escape_string)
+    def flush(self):
+        """
+        Parse the output lazy mode held on to.
+        """
 
-            if is_escape_end(self.escape_string):
-                self.handle_escape_string(self.escape_string)
-                self.escape_string = None
+        if not self.pending and not self.skipped:
+            return
 
-        elif char == ESCAPE:
-            self.escape_string = []
-        elif char == BACKSPACE:
+        self.drop_hidden()
+
+        if self.skipped:
+            # the skipped output ended in a new line, so that's where the tail starts
+            self.skipped = False
+            self.escape_state = GROUND
+            self.handle_lf(self.previous_char)
+            self.previous_char = LF
+            self.mark_all_dirty()
+
+        # don't parse it again if it turns out to be invalid
+        text = bytes(self.pending)
+        self.pending = bytearray()
+        self.pending_limit = LAZY_LIMIT
+        self.parse(text)
+
+    def parse(self, text):
+        length = len(text)
+        i = 0
+        while i < length:
+            if self.escape_state == GROUND:
+                end = find_visible_run(text, i)
+                if end > i:
+                    self.handle_visible_run(bytes(text[i:end]))
+                    i = end
+                    continue
+
+            self.write_char(text[i])
+            i += 1
+
+    def write_char(self, dec):
+        if self.escape_state != GROUND:
+            self.write_escape(dec)
+        elif dec == ESCAPE:
+            self.start_escape()
+        elif dec == BACKSPACE:
             self.handle_backspace()
-        elif char == CR:
+        elif dec == CR:
             self.handle_cr()
-        elif char == LF:
+        elif dec == LF:
             self.handle_lf(self.previous_char)
         elif dec < 32 or dec > 126:
-            raise UnknownCharacter(char)
+            raise UnknownCharacter(dec)
+        else:
+            self.handle_visible(dec)
+
+        self.previous_char = dec
+
+    def start_escape(self):
+        self.escape_state = ESCAPE_STATE
+        self.escape_length = 0
+        self.escape_private = False
+        for index in range(self.param_count):
+            self.params[index] = 0
+        self.param_count = 0
+
+    def write_escape(self, dec):
+        self.escape_length += 1
+        if self.escape_length > MAX_ESCAPE_STRING:
+            self.escape_state = GROUND
+            raise TooLongEscapeString(self.escape_length)
+
+        action = TRANSITIONS[self.escape_state * NUM_CLASSES + BYTE_CLASSES[dec]]
+
+        if action == ACTION_DIGIT:
+            if self.param_count == 0:
+                self.param_count = 1
+            index = self.param_count - 1
+            self.params[index] = self.params[index] * 10 + dec - 48
+        elif action == ACTION_CSI_DISPATCH:
+            self.escape_state = GROUND
+            handler = None if self.escape_private else self.csi_handlers.get(dec)
+            if handler == None:
+                raise UnsupportedEscapeSequence(chr(dec))
+            handler()
+        elif action == ACTION_SEPARATOR:
+            # an empty first parameter still counts
+            if self.param_count == 0:
+                self.param_count = 1
+            self.param_count += 1
+        elif action == ACTION_TO_CSI:
+            self.escape_state = CSI
+        elif action == ACTION_TO_NUMERIC:
+            self.escape_state = NUMERIC
+            self.param_count = 1
+            self.params[0] = dec - 48
+        elif action == ACTION_PRIVATE:
+            self.escape_private = True
+        elif action == ACTION_TO_CHARSET:
+            self.escape_state = CHARSET
+        elif action == ACTION_TO_HASH:
+            self.escape_state = HASH
+        elif action == ACTION_END:
+            # we don't handle any of these yet
+            self.escape_state = GROUND
+            raise UnsupportedEscapeSequence(chr(dec))
         else:
-            self.handle_visible(char)
+            # if it doesn't look like any escape sequence we know about, then we're in uncharted territory
+            self.escape_state = GROUND
+            raise UnknownEscapeEnding(chr(dec))
+
+    def param(self, index, default):
+        """
+        Return the numeric parameter at index, or default if it was left out or 0
+        """
+
+        if index < self.param_count and self.params[index]:
+            return self.params[index]
+        return default
+
+    def cursor_up(self):
+        # the cursor can only move within the line being edited
+        rows = min(self.param(0, 1), self.offset // self.cols)
+        self.move_cursor_to(self.offset - rows * self.cols)
+
+    def cursor_down(self):
+        rows = min(self.param(0, 1), len(self.line()) // self.cols - self.offset // self.cols)
+        self.move_cursor_to(self.offset + rows * self.cols)
+
+    def cursor_forward(self):
+        # like cursor_back this moves along the line, wrapping from row to row
+        self.move_cursor_to(self.offset + self.param(0, 1))
 
-        self.previous_char = char
+    def cursor_back(self):
+        self.move_cursor_left(self.param(0, 1))
 
-    def handle_escape_string(self, escape_string):
-        first = escape_string[0]
-        last = escape_string[len(escape_string) - 1]
-        if first == '[':
-            if len(escape_string) == 2 and last == 'K':
-                return self.clear_line_from_cursor()
-            if last == 'D':
-                num_chars = int(''.join(escape_string[1:-1]))
-                return self.move_cursor_left(num_chars)
+    def cursor_position(self):
+        row = self.param(0, 1) - 1
+        col = min(self.param(1, 1) - 1, self.cols - 1)
 
-        # we don't handle any others yet
-        raise UnsupportedEscapeSequence(escape_string)
+        # clamp to the rows of the line being edited
+        start_row = self.cursor_y - self.offset // self.cols
+        row = min(max(row - start_row, 0), len(self.line()) // self.cols)
+
+        self.move_cursor_to(row * self.cols + col)
+
+    def erase_display(self):
+        mode = self.param(0, 0)
+        if mode == 0:
+            # there is nothing below the line being edited
+            return self.clear_line_from_cursor()
+        if mode == 1 or mode == 2:
+            self.blank_lines_above()
+            return self.erase_line(mode)
+
+        raise UnsupportedEscapeSequence('J')
+
+    def erase_line(self, mode=None):
+        if mode == None:
+            mode = self.param(0, 0)
+        if mode == 0:
+            return self.clear_line_from_cursor()
+
+        line = self.line()
+        if mode == 1:
+            end = min(self.offset + 1, len(line))
+            self.change(SPACE * end + line[end:], 0, end)
+        elif mode == 2:
+            # keep the length so the line still takes up the same rows
+            self.change(SPACE * len(line))
+        else:
+            raise UnsupportedEscapeSequence('K')
+
+    def select_graphic_rendition(self):
+        # we don't draw any character attributes
+        pass
 
     def clear_line_from_cursor(self):
         line = self.line()
-        self.change(line[:self.offset])
+        self.change(line[:self.offset], self.offset)
 
     def move_cursor_left(self, num_chars):
+        self.move_cursor_to(max(self.offset - num_chars, 0))
+
+    def move_cursor_to(self, offset):
         mark = self.start_change()
-        self.offset = max(self.offset - num_chars, 0)
+
+        # moving past the end of the line pads it with spaces
+        line = self.line()
+        if offset > len(line):
+            self.lines[-1] = line + SPACE * (offset - len(line))
+
+        self.offset = offset
+        self.update_cursor()
         mark.apply()
 
+    def blank_lines_above(self):
+        """
+        Blank the lines above the one being edited that are on the screen
+        """
+
+        remaining = self.cursor_y - self.offset // self.cols
+        for y in range(remaining):
+            self.mark_dirty(y)
+
+        index = len(self.lines) - 2
+        while remaining > 0 and index >= 0:
+            count = self.wrapped.count(index)
+            # keep the number of rows so the screen doesn't shift
+            self.lines[index] = SPACE * ((count - 1) * self.cols)
+            remaining -= count
+            index -= 1
+
     def handle_backspace(self):
         self.move_cursor_left(1)
 
@@ -281,20 +807,26 @@ class TextBuffer:
     def handle_lf(self, previous):
         # could be CRLF or LF
 
+        old_x = self.x()
         old_y = self.y()
 
+        # the new line goes below the last row of the current one, which is not necessarily where the cursor is
+        count = self.wrapped.count(-1)
+        scroll = self.rows_above + count >= self.rows
+        self.rows_above = min(self.rows, self.rows_above + count)
+
         # CR
         self.offset = 0
         # current line is dirty because the cursor is no longer there
-        self.dirty.add(old_y)
+        self.mark_dirty(old_y, old_x, old_x + 1)
 
         # LF
-        self.lines.append('')
-        self.wrapped.append([''])
+        self.lines.append(b'')
+        self.update_cursor()
 
-        if old_y < self.rows - 1:
-            # new line is dirty
-            self.dirty.add(old_y + 1)
+        if not scroll:
+            # new line is dirty, but it is still blank apart from the cursor
+            self.mark_dirty(self.y(), 0, 1)
         else:
             #debug({
             #    "scrolling": True,
@@ -302,59 +834,136 @@ class TextBuffer:
             #})
 
             # no room for the new line, we have to scroll, so the whole buffer is dirty
-            for y in range(self.rows):
-                self.dirty.add(y)
+            self.mark_all_dirty()
 
-            # trim lines and wrapped
-            self.lines = self.lines[-self.rows:]
-            self.wrapped = self.wrapped[-self.rows:]
+    def handle_visible(self, dec):
+        self.handle_visible_run(bytes((dec,)))
 
-    def handle_visible(self, char):
-        # insert/overwrite the char at the cursor
+    def handle_visible_run(self, run):
+        # insert/overwrite the chars at the cursor
         line = self.line()
-        mark = self.change(line[:self.offset] + char + line[self.offset+1:], False)
+        length = len(run)
+
+        if count_wrapped_rows(max(len(line), self.offset + length), self.cols) > self.rows:
+            self.handle_overlong_run(line, run)
+            return
+
+        mark = self.change(line[:self.offset] + run + line[self.offset+length:], self.offset, self.offset + length, False)
 
         # move the cursor
-        self.offset += 1
+        self.offset += length
+        self.update_cursor()
+
+        self.previous_char = run[-1]
 
         # mark as dirty whatever is necessary
         mark.apply()
 
-    def get_screen_lines(self):
+    def handle_overlong_run(self, line, run):
+        """
+        Insert/overwrite a run that makes the line wrap to more rows than fit
+        on the screen. The rows at the start of the line go, they would have
+        scrolled off the top anyway. Only if the cursor is on one of them it
+        is still too long.
+        """
+
+        length = len(run)
+        line = line[:self.offset] + run + line[self.offset+length:]
+        offset = self.offset + length
+
+        drop = (count_wrapped_rows(len(line), self.cols) - self.rows) * self.cols
+        if drop <= offset:
+            line = line[drop:]
+            offset -= drop
+
+        self.lines[-1] = line
+        self.offset = offset
+        self.update_cursor()
+        self.previous_char = run[-1]
+
+        # the whole screen is this line now
+        self.mark_all_dirty()
+
+    def max_scroll(self):
+        """
+        Return how many rows the screen can be scrolled back through the scrollback
+        """
+
+        total = 0
+        for index in range(len(self.wrapped)):
+            total += self.wrapped.count(index)
+        return max(total - self.rows, 0)
+
+    def get_screen_lines(self, scroll=0):
+        """
+        Return the rows on screen, or the window of rows that would be on
+        screen when scrolled back by scroll rows
+        """
+
         screen_lines = []
-        for wrapped_lines in reversed(self.wrapped):
-            for wrapped_line in reversed(wrapped_lines):
-                screen_lines.append(wrapped_line)
-                if len(screen_lines) == self.rows:
-                    break
-            if len(screen_lines) == self.rows:
-                break
+        index = len(self.wrapped) - 1
+        while index >= 0 and len(screen_lines) < self.rows:
+            row = self.wrapped.count(index) - 1
+            if scroll > row:
+                # this entire line is below the window
+                scroll -= row + 1
+                index -= 1
+                continue
+            row -= scroll
+            scroll = 0
+            while row >= 0 and len(screen_lines) < self.rows:
+                screen_lines.append(self.wrapped.part(index, row))
+                row -= 1
+            index -= 1
         screen_lines.reverse()
         return screen_lines
 
+    def is_dirty(self):
+        """
+        Return whether pop() would return anything, without allocating.
+        """
+
+        if self.pending or self.skipped:
+            return True
+
+        for y in range(self.rows):
+            if self.dirty_end[y] > self.dirty_start[y]:
+                return True
+        return False
+
     def pop(self):
         """
-        Return dirty lines and reset it.
+        Return dirty lines and reset them.
+
+        Keys are row numbers, values are (line, start, end) where start and
+        end are the dirty columns of that row.
         """
 
+        self.flush()
+
         # get the lines that make up the screen
         screen_lines = self.get_screen_lines()
 
         # pull out the dirty lines into line_dict, dict key is the line number
         line_dict = {}
-        for y in self.dirty:
+        for y in range(self.rows):
+            start = self.dirty_start[y]
+            end = self.dirty_end[y]
+            if end <= start:
+                continue
+
             if len(screen_lines) > y:
-                line_dict[y] = screen_lines[y]
+                line_dict[y] = (screen_lines[y], start, end)
             else:
-                line_dict[y] = ''
+                line_dict[y] = (b'', start, end)
+
+            self.dirty_start[y] = 0
+            self.dirty_end[y] = 0
 
         #debug({
-        #    "dirty": self.dirty,
         #    "screen_lines": screen_lines,
         #    "line_dict": line_dict
         #})
 
-        self.dirty = set()
-
         return line_dict
 
@@ -117,6 +117,13 @@ KNOWN_ESCAPE_SEQUENCES = [
     ['Esc[4q', 'Turn on LED #4', 'DECLL4']
 ]
 
+def pop_lines(tb):
+    """
+    Pop the dirty rows, dropping the dirty column spans
+    """
+
+    return { y: line for y, (line, start, end) in tb.pop().items() }
+
 def replace_sequence_placeholders(sequence):
     return (sequence
         .replace('Value', '111')
@@ -126,62 +133,105 @@ def replace_sequence_placeholders(sequence):
 def test_known_sequence():
     for [sequence, description, name] in KNOWN_ESCAPE_SEQUENCES:
         sequence = replace_sequence_placeholders(sequence)
-        chars = list(sequence[3:])
-        assert is_escape_end(chars)
-        if len(chars) > 1:
-            assert is_escape_end(chars[:-1]) == False
+        tb = TextBuffer(16, 16)
+        tb.write(chr(27) + sequence[3:-1])
+        # not complete until the last char
+        assert tb.escape_state != GROUND
+        try:
+            tb.write(sequence[-1])
+        except UnsupportedEscapeSequence:
+            pass
+        assert tb.escape_state == GROUND
 
 def test_unknown_escape_ending():
     with pytest.raises(UnknownEscapeEnding):
-        is_escape_end([' ', ' ']) # fails on the second char
+        tb = TextBuffer(16, 2)
+        tb.write(b'\x1b ')
+
+def test_unknown_escape_ending_in_csi():
+    tb = TextBuffer(16, 2)
+    with pytest.raises(UnknownEscapeEnding):
+        tb.write(b'\x1b[1 ')
+    # the parser starts over after an error
+    assert tb.escape_state == GROUND
+    tb.write('a')
+    assert tb.line() == b'a'
 
 def test_unknown_character():
     with pytest.raises(UnknownCharacter):
         tb = TextBuffer(16, 2)
-        tb.write([0])
+        tb.write(b'\x00')
 
 def test_unsupported_escape_sequence():
     with pytest.raises(UnsupportedEscapeSequence):
         tb = TextBuffer(16, 2)
-        tb.write([27, ord('c')])
+        tb.write(b'\x1bc')
 
 def test_wrap_line():
-    assert wrap_line('*'*16, 16) == ['*'*16, '']
-    assert wrap_line('*'*17, 16) == ['*'*16, '*']
-    assert wrap_line('*'*32, 16) == ['*'*16, '*'*16, '']
+    assert wrap_line(b'*'*16, 16) == [b'*'*16, b'']
+    assert wrap_line(b'*'*17, 16) == [b'*'*16, b'*']
+    assert wrap_line(b'*'*32, 16) == [b'*'*16, b'*'*16, b'']
 
 def test_offset_not_found():
     with pytest.raises(OffsetNotFound):
-        find_y_in_wrapped_line(100, [], 16)
+        find_y_in_wrapped_line(100, 0, 16)
 
 def test_line_too_long():
     with pytest.raises(TooLongLine):
         # 32-character long line on a 16x2 screen should throw
-        calculate_row(100, [['*'*16, '*'*16, '']], 16, 2)
+        calculate_row(100, WrapView(['*'*32], 16), 16, 2)
 
 def test_too_long_escape_string():
     tb = TextBuffer(16, 2)
     with pytest.raises(TooLongEscapeString):
         tb.write(chr(27) + '[' + '1'*10)
 
-# TODO: tests for find_y_in_wrapped_line
-
-# TODO: tests for calculate_row
+def test_wrap_view():
+    wrapped = WrapView(['', '*'*16, '+'*20], 16)
+    assert len(wrapped) == 3
+    for index, line in enumerate(wrapped.lines):
+        parts = wrap_line(line, 16)
+        assert wrapped.count(index) == len(parts)
+        for row, part in enumerate(parts):
+            assert wrapped.part(index, row) == part
+
+def test_find_x_in_wrapped_line():
+    assert find_x_in_wrapped_line(0, 0, 16) == 0
+    assert find_x_in_wrapped_line(15, 20, 16) == 15
+    assert find_x_in_wrapped_line(16, 16, 16) == 0
+    assert find_x_in_wrapped_line(18, 20, 16) == 2
+
+def test_find_y_in_wrapped_line():
+    assert find_y_in_wrapped_line(0, 0, 16) == 0
+    assert find_y_in_wrapped_line(15, 16, 16) == 0
+    # at the end of a full row the cursor is on the blank row after it
+    assert find_y_in_wrapped_line(16, 16, 16) == 1
+    assert find_y_in_wrapped_line(16, 20, 16) == 1
+    assert find_y_in_wrapped_line(32, 40, 16) == 2
+
+def test_calculate_row():
+    # not enough lines to fill the screen yet
+    assert calculate_row(0, WrapView([''], 16), 16, 4) == 0
+    assert calculate_row(3, WrapView(['hello', '*'*20], 16), 16, 4) == 1
+    assert calculate_row(20, WrapView(['hello', '*'*20], 16), 16, 4) == 2
+    # a full screen
+    assert calculate_row(0, WrapView(['*'*20, '*'*20, '*'*20], 16), 16, 4) == 2
+    assert calculate_row(16, WrapView(['*'*20, '*'*20, '*'*20], 16), 16, 4) == 3
 
 def test_clear_line_from_cursor_unchanged_num_lines():
     tb = TextBuffer(16, 2)
     tb.write('hello\nthere')
     tb.write('\b')
     tb.write('\b')
-    line_dict = tb.pop()
-    assert line_dict == { 0: 'hello', 1: 'there' }
+    line_dict = pop_lines(tb)
+    assert line_dict == { 0: b'hello', 1: b'there' }
     assert tb.offset == 3
     assert tb.x() == 3
     assert tb.y() == 1
 
-    tb.write([27, '[', 'K'])
-    line_dict = tb.pop()
-    assert line_dict == { 1: 'the' }
+    tb.write(b'\x1b[K')
+    line_dict = pop_lines(tb)
+    assert line_dict == { 1: b'the' }
     assert tb.offset == 3
     assert tb.x() == 3
     assert tb.y() == 1
@@ -189,16 +239,16 @@ def test_clear_line_from_cursor_unchanged_num_lines():
 def test_clear_line_from_cursor_changed_num_lines():
     tb = TextBuffer(16, 2)
     tb.write('*' * 20)
-    tb.write([27, '[', '1', '0', 'D'])
-    line_dict = tb.pop()
-    assert line_dict == { 0: '*'*16, 1: '*'*4 }
+    tb.write(b'\x1b[10D')
+    line_dict = pop_lines(tb)
+    assert line_dict == { 0: b'*'*16, 1: b'*'*4 }
     assert tb.offset == 10
     assert tb.x() == 10
     assert tb.y() == 0
 
-    tb.write([27, '[', 'K'])
-    line_dict = tb.pop()
-    assert line_dict == { 0: '*'*10, 1: '' }
+    tb.write(b'\x1b[K')
+    line_dict = pop_lines(tb)
+    assert line_dict == { 0: b'*'*10, 1: b'' }
     assert tb.offset == 10
     assert tb.x() == 10
     assert tb.y() == 0
@@ -206,15 +256,15 @@ def test_clear_line_from_cursor_changed_num_lines():
 def test_move_cursor_left_within_line():
     tb = TextBuffer(16, 2)
     tb.write('*' * 20)
-    line_dict = tb.pop()
-    assert line_dict == { 0: '*'*16, 1: '*'*4 }
+    line_dict = pop_lines(tb)
+    assert line_dict == { 0: b'*'*16, 1: b'*'*4 }
     assert tb.offset == 20
     assert tb.x() == 4
     assert tb.y() == 1
 
-    tb.write([27, '[', '2', 'D'])
-    line_dict = tb.pop()
-    assert line_dict == { 1: '*'*4 }
+    tb.write(b'\x1b[2D')
+    line_dict = pop_lines(tb)
+    assert line_dict == { 1: b'*'*4 }
     assert tb.offset == 18
     assert tb.x() == 2
     assert tb.y() == 1
@@ -222,15 +272,15 @@ def test_move_cursor_left_within_line():
 def test_move_cursor_left_crossing_edge():
     tb = TextBuffer(16, 2)
     tb.write('*' * 20)
-    line_dict = tb.pop()
-    assert line_dict == { 0: '*'*16, 1: '*'*4 }
+    line_dict = pop_lines(tb)
+    assert line_dict == { 0: b'*'*16, 1: b'*'*4 }
     assert tb.offset == 20
     assert tb.x() == 4
     assert tb.y() == 1
 
-    tb.write([27, '[', '1', '0', 'D'])
-    line_dict = tb.pop()
-    assert line_dict == { 0: '*'*16, 1: '*'*4 }
+    tb.write(b'\x1b[10D')
+    line_dict = pop_lines(tb)
+    assert line_dict == { 0: b'*'*16, 1: b'*'*4 }
     assert tb.offset == 10
     assert tb.x() == 10
     assert tb.y() == 0
@@ -238,15 +288,15 @@ def test_move_cursor_left_crossing_edge():
 def test_backspace_within_line():
     tb = TextBuffer(16, 2)
     tb.write('*' * 20)
-    line_dict = tb.pop()
-    assert line_dict == { 0: '*'*16, 1: '*'*4 }
+    line_dict = pop_lines(tb)
+    assert line_dict == { 0: b'*'*16, 1: b'*'*4 }
     assert tb.offset == 20
     assert tb.x() == 4
     assert tb.y() == 1
 
     tb.write('\b')
-    line_dict = tb.pop()
-    assert line_dict == { 1: '*'*4 }
+    line_dict = pop_lines(tb)
+    assert line_dict == { 1: b'*'*4 }
     assert tb.offset == 19
     assert tb.x() == 3
     assert tb.y() == 1
@@ -254,15 +304,15 @@ def test_backspace_within_line():
 def test_backspace_crossing_edge():
     tb = TextBuffer(16, 2)
     tb.write('*' * 16)
-    line_dict = tb.pop()
-    assert line_dict == { 0: '*'*16, 1: '' }
+    line_dict = pop_lines(tb)
+    assert line_dict == { 0: b'*'*16, 1: b'' }
     assert tb.offset == 16
     assert tb.x() == 0
     assert tb.y() == 1
 
     tb.write('\b')
-    line_dict = tb.pop()
-    assert line_dict == { 0: '*'*16, 1: '' }
+    line_dict = pop_lines(tb)
+    assert line_dict == { 0: b'*'*16, 1: b'' }
     assert tb.offset == 15
     assert tb.x() == 15
     assert tb.y() == 0
@@ -270,15 +320,15 @@ def test_backspace_crossing_edge():
 def test_newline_without_scrolling():
     tb = TextBuffer(16, 2)
     tb.write('>>> ')
-    line_dict = tb.pop()
-    assert line_dict == { 0: '>>> ' }
+    line_dict = pop_lines(tb)
+    assert line_dict == { 0: b'>>> ' }
     assert tb.offset == 4
     assert tb.x() == 4
     assert tb.y() == 0
 
     tb.write('\n')
-    line_dict = tb.pop()
-    assert line_dict == { 0: '>>> ', 1: '' }
+    line_dict = pop_lines(tb)
+    assert line_dict == { 0: b'>>> ', 1: b'' }
     assert tb.offset == 0
     assert tb.x() == 0
     assert tb.y() == 1
@@ -286,15 +336,15 @@ def test_newline_without_scrolling():
 def test_newline_with_scrolling():
     tb = TextBuffer(16, 2)
     tb.write('>>> \n')
-    line_dict = tb.pop()
-    assert line_dict == { 0: '>>> ', 1: '' }
+    line_dict = pop_lines(tb)
+    assert line_dict == { 0: b'>>> ', 1: b'' }
     assert tb.offset == 0
     assert tb.x() == 0
     assert tb.y() == 1
 
     tb.write('\n')
-    line_dict = tb.pop()
-    assert line_dict == { 0: '', 1: '' }
+    line_dict = pop_lines(tb)
+    assert line_dict == { 0: b'', 1: b'' }
     assert tb.offset == 0
     assert tb.x() == 0
     assert tb.y() == 1
@@ -302,15 +352,15 @@ def test_newline_with_scrolling():
 def test_new_character_without_wrapping():
     tb = TextBuffer(16, 2)
     tb.write('\n')
-    line_dict = tb.pop()
-    assert line_dict == { 0: '', 1: '' }
+    line_dict = pop_lines(tb)
+    assert line_dict == { 0: b'', 1: b'' }
     assert tb.offset == 0
     assert tb.x() == 0
     assert tb.y() == 1
 
     tb.write('*')
-    line_dict = tb.pop()
-    assert line_dict == { 1: '*' }
+    line_dict = pop_lines(tb)
+    assert line_dict == { 1: b'*' }
     assert tb.offset == 1
     assert tb.x() == 1
     assert tb.y() == 1
@@ -318,23 +368,23 @@ def test_new_character_without_wrapping():
 def test_new_character_with_wrapping_without_scrolling():
     tb = TextBuffer(16, 2)
     tb.write('*'*15)
-    line_dict = tb.pop()
-    assert line_dict == { 0: '*'*15 }
+    line_dict = pop_lines(tb)
+    assert line_dict == { 0: b'*'*15 }
     assert tb.offset == 15
     assert tb.x() == 15
     assert tb.y() == 0
 
     tb.write('*')
-    line_dict = tb.pop()
-    assert line_dict == { 0: '*'*16, 1:'' }
+    line_dict = pop_lines(tb)
+    assert line_dict == { 0: b'*'*16, 1:b'' }
     assert tb.offset == 16
     assert tb.x() == 0
     assert tb.y() == 1
 
     # once wrapped we can add more
     tb.write('*')
-    line_dict = tb.pop()
-    assert line_dict == { 1:'*' }
+    line_dict = pop_lines(tb)
+    assert line_dict == { 1:b'*' }
     assert tb.offset == 17
     assert tb.x() == 1
     assert tb.y() == 1
@@ -342,15 +392,15 @@ def test_new_character_with_wrapping_without_scrolling():
 def test_new_character_with_wrapping_with_scrolling():
     tb = TextBuffer(16, 2)
     tb.write('\n' + '*'*15)
-    line_dict = tb.pop()
-    assert line_dict == { 0: '', 1: '*'*15 }
+    line_dict = pop_lines(tb)
+    assert line_dict == { 0: b'', 1: b'*'*15 }
     assert tb.offset == 15
     assert tb.x() == 15
     assert tb.y() == 1
 
     tb.write('*')
-    line_dict = tb.pop()
-    assert line_dict == { 0: '*'*16, 1:'' }
+    line_dict = pop_lines(tb)
+    assert line_dict == { 0: b'*'*16, 1:b'' }
     assert tb.offset == 16
     assert tb.x() == 0
     assert tb.y() == 1
@@ -358,8 +408,450 @@ def test_new_character_with_wrapping_with_scrolling():
 def test_swallows_cr():
     tb = TextBuffer(16, 2)
     tb.write('\r');
-    line_dict = tb.pop()
+    line_dict = pop_lines(tb)
     assert line_dict == {}
     assert tb.offset == 0
     assert tb.x() == 0
     assert tb.y() == 0
+
+def write_per_char(tb, text):
+    for dec in text.encode():
+        tb.write_char(dec)
+
+RUN_SAMPLES = [
+    '>>> print("hello")\r\nhello\r\n>>> ',
+    '*'*40 + '\x1b[30D' + 'abc' + '\x1b[K' + '\r\n' + 'x'*33,
+    'Traceback (most recent call last):\r\n  File "<stdin>", line 1\r\n' + 'y'*70,
+    '\n\n\n' + '*'*16 + '\b\b\b' + '+'*20,
+]
+
+def test_visible_run_matches_per_char():
+    for sample in RUN_SAMPLES:
+        for text in [sample, sample.encode(), bytearray(sample.encode()), memoryview(sample.encode())]:
+            fast = TextBuffer(16, 5)
+            slow = TextBuffer(16, 5)
+            fast.write(text)
+            write_per_char(slow, sample)
+            assert list(fast.lines) == list(slow.lines)
+            assert fast.offset == slow.offset
+            assert fast.previous_char == slow.previous_char
+            assert fast.dirty_start == slow.dirty_start
+            assert fast.dirty_end == slow.dirty_end
+            assert fast.x() == slow.x()
+            assert fast.y() == slow.y()
+
+def test_visible_run_overwriting_across_rows():
+    tb = TextBuffer(16, 4)
+    tb.write('*'*40)
+    tb.write('\x1b[40D')
+    tb.pop()
+    tb.write('+'*40)
+    line_dict = pop_lines(tb)
+    assert line_dict == { 0: b'+'*16, 1: b'+'*16, 2: b'+'*8 }
+    assert tb.offset == 40
+
+def test_cached_cursor_matches_calculation():
+    for sample in RUN_SAMPLES:
+        tb = TextBuffer(16, 5, debug=True)
+        tb.write(sample)
+        tb.clear()
+        write_per_char(tb, sample)
+
+    tb = TextBuffer(16, 5, [b'hello', b'*'*20, b'there'], debug=True)
+    assert tb.x() == 0
+    assert tb.y() == 3
+
+def test_cursor_mismatch():
+    tb = TextBuffer(16, 2, debug=True)
+    tb.cursor_y = 1
+    with pytest.raises(CursorMismatch):
+        tb.check_cursor()
+
+def test_newline_with_cursor_before_end_of_line():
+    tb = TextBuffer(16, 4, debug=True)
+    tb.write('*'*20 + '\x1b[10D')
+    tb.pop()
+    assert tb.y() == 0
+
+    # the new line goes below the wrapped part of the line, not below the cursor
+    tb.write('\n')
+    line_dict = pop_lines(tb)
+    assert line_dict == { 0: b'*'*16, 2: b'' }
+    assert tb.x() == 0
+    assert tb.y() == 2
+
+def test_scrollback():
+    lines = Scrollback(3, [b'a', b'b'])
+    assert len(lines) == 2
+    assert lines[-1] == b'b'
+    lines.append(b'c')
+    lines.append(b'd')
+    assert len(lines) == 3
+    assert list(lines) == [b'b', b'c', b'd']
+    assert lines[0] == b'b'
+    lines[-1] = b'e'
+    assert list(lines) == [b'b', b'c', b'e']
+    with pytest.raises(IndexError):
+        lines[3]
+    lines.clear()
+    assert len(lines) == 0
+
+def test_scrollback_depth():
+    tb = TextBuffer(16, 2, scrollback=5)
+    for i in range(10):
+        tb.write(str(i) + '\r\n')
+    assert list(tb.lines) == [b'6', b'7', b'8', b'9', b'']
+    assert tb.y() == 1
+
+    # never keep fewer lines than fit on the screen
+    tb = TextBuffer(16, 4, scrollback=1)
+    assert tb.lines.capacity == 4
+
+def test_screen_lines_scrolled_back():
+    tb = TextBuffer(16, 3)
+    tb.write('one\r\n' + '*'*20 + '\r\nthree\r\nfour')
+    assert tb.get_screen_lines() == [b'****', b'three', b'four']
+    assert tb.max_scroll() == 2
+    assert tb.get_screen_lines(1) == [b'*'*16, b'****', b'three']
+    assert tb.get_screen_lines(2) == [b'one', b'*'*16, b'****']
+    assert tb.get_screen_lines(3) == [b'one', b'*'*16]
+
+def test_cursor_up_and_down():
+    tb = TextBuffer(16, 4, debug=True)
+    tb.write('*'*40)
+    tb.write('\x1b[A')
+    assert tb.offset == 24
+    assert (tb.x(), tb.y()) == (8, 1)
+    # can't move above the line being edited
+    tb.write('\x1b[5A')
+    assert tb.offset == 8
+    assert (tb.x(), tb.y()) == (8, 0)
+    tb.write('\x1b[B')
+    assert tb.offset == 24
+    # or below it
+    tb.write('\x1b[9B')
+    assert tb.offset == 40
+    assert (tb.x(), tb.y()) == (8, 2)
+
+def test_cursor_forward():
+    tb = TextBuffer(16, 4, debug=True)
+    tb.write('hello\x1b[5D')
+    tb.write('\x1b[C')
+    assert tb.offset == 1
+    # moving past the end of the line pads it
+    tb.write('\x1b[8C')
+    assert tb.offset == 9
+    assert tb.line() == b'hello    '
+
+def test_cursor_position():
+    tb = TextBuffer(16, 4, debug=True)
+    tb.write('one\r\n' + '*'*20)
+    tb.write('\x1b[H')
+    # row 1 is above the line being edited so the cursor goes to its first row
+    assert tb.offset == 0
+    tb.write('\x1b[3;5H')
+    assert tb.offset == 20
+    assert (tb.x(), tb.y()) == (4, 2)
+    tb.write('\x1b[2;3f')
+    assert tb.offset == 2
+    tb.write('\x1b[3;9f')
+    assert tb.offset == 24
+    assert tb.line() == b'*'*20 + b'    '
+
+def test_erase_line():
+    tb = TextBuffer(16, 4, debug=True)
+    tb.write('hello there\x1b[5D')
+    tb.pop()
+    tb.write('\x1b[0K')
+    assert tb.line() == b'hello '
+    tb.write('\x1b[3D\x1b[1K')
+    assert tb.line() == b'    o '
+    tb.write('\x1b[2K')
+    assert tb.line() == b' '*6
+    assert tb.offset == 3
+    assert pop_lines(tb) == { 0: b' '*6 }
+
+def test_erase_display():
+    tb = TextBuffer(16, 4, debug=True)
+    tb.write('one\r\n' + '*'*20 + '\r\nthree')
+    tb.pop()
+    tb.write('\x1b[2D\x1b[J')
+    assert tb.line() == b'thr'
+    tb.write('\x1b[1J')
+    assert tb.line() == b'   '
+    assert list(tb.lines) == [b'', b' '*16, b'   ']
+    assert pop_lines(tb) == { 0: b'', 1: b' '*16, 2: b'', 3: b'   ' }
+
+    tb = TextBuffer(16, 4, debug=True)
+    tb.write('one\r\ntwo\x1b[1D\x1b[2J')
+    assert list(tb.lines) == [b'', b'   ']
+    assert tb.offset == 2
+
+def test_select_graphic_rendition_is_ignored():
+    tb = TextBuffer(16, 2)
+    tb.write('\x1b[1mbold\x1b[0m \x1b[7;4mreverse\x1b[m')
+    assert tb.line() == b'bold reverse'
+
+def test_private_sequence_is_unsupported():
+    tb = TextBuffer(16, 2)
+    with pytest.raises(UnsupportedEscapeSequence):
+        tb.write('\x1b[?25l')
+
+def test_dirty_spans_typing():
+    tb = TextBuffer(16, 4)
+    tb.write('>>> ')
+    tb.pop()
+    tb.write('a')
+    # the new char and the cursor after it
+    assert tb.pop() == { 0: (b'>>> a', 4, 6) }
+    tb.write('\b')
+    assert tb.pop() == { 0: (b'>>> a', 4, 6) }
+
+def test_dirty_spans_clear_line():
+    tb = TextBuffer(16, 4)
+    tb.write('>>> hello\x1b[3D')
+    tb.pop()
+    tb.write('\x1b[K')
+    assert tb.pop() == { 0: (b'>>> he', 6, 9) }
+
+def test_dirty_spans_across_rows():
+    tb = TextBuffer(16, 4)
+    tb.write('*'*40 + '\x1b[30D')
+    tb.pop()
+    tb.write('+'*20)
+    assert tb.pop() == {
+        0: (b'*'*10 + b'+'*6, 10, 16),
+        1: (b'+'*14 + b'*'*2, 0, 15),
+    }
+
+def test_dirty_spans_newline():
+    tb = TextBuffer(16, 4)
+    tb.write('>>> 1')
+    tb.pop()
+    tb.write('\r\n')
+    assert tb.pop() == { 0: (b'>>> 1', 5, 6), 1: (b'', 0, 1) }
+
+def test_dirty_spans_wrapping_without_scrolling():
+    tb = TextBuffer(16, 4)
+    tb.write('>>> \r\n' + '*'*15)
+    tb.pop()
+    tb.write('*')
+    # only the new char and the cursor on the new row, not the entire screen
+    assert tb.pop() == { 1: (b'*'*16, 15, 16), 2: (b'', 0, 1) }
+    tb.write('*')
+    assert tb.pop() == { 2: (b'*', 0, 2) }
+
+def test_dirty_spans_unwrapping_without_scrolling():
+    tb = TextBuffer(16, 4)
+    tb.write('*'*20 + '\x1b[10D')
+    tb.pop()
+    tb.write('\x1b[K')
+    assert tb.pop() == { 0: (b'*'*10, 10, 16), 1: (b'', 0, 4) }
+
+def test_dirty_spans_wrapping_with_scrolling():
+    tb = TextBuffer(16, 4)
+    tb.write('1\r\n2\r\n3\r\n' + '*'*15)
+    tb.pop()
+    tb.write('*')
+    assert pop_lines(tb) == { 0: b'2', 1: b'3', 2: b'*'*16, 3: b'' }
+
+def test_dirty_spans_unwrapping_with_scrolling():
+    tb = TextBuffer(16, 4)
+    tb.write('1\r\n2\r\n3\r\n' + '*'*20 + '\x1b[10D')
+    tb.pop()
+    tb.write('\x1b[K')
+    # the line above scrolls back into view
+    assert pop_lines(tb) == { 0: b'1', 1: b'2', 2: b'3', 3: b'*'*10 }
+
+def test_is_dirty():
+    tb = TextBuffer(16, 4)
+    assert not tb.is_dirty()
+    tb.write('a')
+    assert tb.is_dirty()
+    tb.pop()
+    tb.write('')
+    assert not tb.is_dirty()
+
+def test_find_tail():
+    assert find_tail(b'a\nb\nc', 3) == -1
+    assert find_tail(b'a\nb\nc', 2) == 2
+    assert find_tail(b'a\nb\n', 1) == 4
+
+def lazy_and_eager(text, cols=16, rows=4):
+    eager = TextBuffer(cols, rows)
+    lazy = TextBuffer(cols, rows, lazy=True)
+    for tb in [eager, lazy]:
+        tb.write(text)
+        tb.pop()
+    return eager, lazy
+
+LAZY_SAMPLES = [
+    '>>> ',
+    ''.join('line %d\r\n' % i for i in range(100)) + '>>> ',
+    ''.join('%d\r\n' % i for i in range(3)) + '*' * 40,
+    '*' * 30 + '\r\n' + ''.join('%d\r\n' % i for i in range(10)) + '\x1b[2Jabc\x1b[2D',
+    # the tail starts with a line that wraps
+    ''.join('%d\r\n' % i for i in range(10)) + '*' * 40 + '\r\n1\r\n2\r\n3',
+    ''.join('%d\r\n' % i for i in range(10)) + '\r\n\r\n\r\n',
+]
+
+@pytest.mark.parametrize("text", LAZY_SAMPLES)
+def test_lazy_matches_eager(text):
+    eager, lazy = lazy_and_eager(text)
+    assert lazy.get_screen_lines() == eager.get_screen_lines()
+    assert (lazy.x(), lazy.y()) == (eager.x(), eager.y())
+
+def test_lazy_defers_until_pop():
+    tb = TextBuffer(16, 4, lazy=True)
+    tb.pop()
+    tb.write('abc')
+    assert tb.line() == b''
+    assert tb.is_dirty()
+    assert pop_lines(tb) == { 0: b'abc' }
+
+def test_lazy_skips_hidden_output():
+    tb = TextBuffer(16, 4, lazy=True)
+    tb.write(''.join('line %d\r\n' % i for i in range(100)) + '>>> ')
+    assert pop_lines(tb) == { 0: b'line 97', 1: b'line 98', 2: b'line 99', 3: b'>>> ' }
+    # the skipped lines are gone from the scrollback
+    assert b'line 50' not in list(tb.lines)
+
+def test_lazy_escape_across_writes():
+    tb = TextBuffer(16, 4, lazy=True)
+    tb.write('abcdef\x1b[')
+    tb.pop()
+    tb.write('3D\x1b[K')
+    assert pop_lines(tb) == { 0: b'abc' }
+    assert tb.x() == 3
+
+def test_lazy_escape_cut_off():
+    tb = TextBuffer(16, 4, lazy=True)
+    tb.write('\x1b[')
+    tb.pop()
+    # the escape sequence scrolls off before it ever gets parsed
+    tb.write('1\r\n2\r\n3\r\n4\r\n5')
+    assert pop_lines(tb) == { 0: b'2', 1: b'3', 2: b'4', 3: b'5' }
+
+def test_lazy_drops_hidden_output_while_writing():
+    tb = TextBuffer(16, 4, lazy=True)
+    for i in range(2000):
+        tb.write('line %d\r\n' % i)
+    assert len(tb.pending) <= 2 * LAZY_LIMIT
+    tb.write('>>> ')
+    assert pop_lines(tb) == { 0: b'line 1997', 1: b'line 1998', 2: b'line 1999', 3: b'>>> ' }
+
+# what print(list(range(10000))) prints, one 58K line
+LONG_DUMP = str(list(range(10000))).encode()
+
+def dump_screen(cols, rows):
+    # the end of the dump followed by the prompt
+    return (wrap_line(LONG_DUMP, cols) + [b'>>> '])[-rows:]
+
+def write_dump(tb, pop_every=0):
+    tb.write(b'>>> print(list(range(10000)))\r\n')
+    output = LONG_DUMP + b'\r\n>>> '
+    largest = 0
+    for index, start in enumerate(range(0, len(output), 256)):
+        tb.write(output[start:start + 256])
+        largest = max(largest, len(tb.pending))
+        if pop_every and index % pop_every == 0:
+            tb.pop()
+    tb.pop()
+    return largest
+
+def test_lazy_long_line():
+    tb = TextBuffer(59, 16, lazy=True)
+    largest = write_dump(tb)
+    assert largest <= LAZY_MAX
+    assert tb.get_screen_lines() == dump_screen(59, 16)
+    assert (tb.x(), tb.y()) == (4, 15)
+
+def test_lazy_long_line_with_refreshes():
+    # refreshes in the middle of it parse part of the line
+    tb = TextBuffer(59, 16, lazy=True)
+    write_dump(tb, pop_every=7)
+    assert tb.get_screen_lines() == dump_screen(59, 16)
+    assert (tb.x(), tb.y()) == (4, 15)
+
+def test_long_line():
+    tb = TextBuffer(59, 16)
+    write_dump(tb)
+    assert tb.get_screen_lines() == dump_screen(59, 16)
+    assert (tb.x(), tb.y()) == (4, 15)
+
+def test_long_line_keeps_the_cursor_row():
+    tb = TextBuffer(16, 2)
+    tb.write('*' * 40)
+    assert tb.get_screen_lines() == [b'*' * 16, b'*' * 8]
+    assert (tb.x(), tb.y()) == (8, 1)
+    assert tb.line() == b'*' * 24
+
+def test_lazy_long_line_with_escapes_is_bounded():
+    tb = TextBuffer(16, 4, lazy=True)
+    for i in range(10000):
+        tb.write('ab\x1b[1D')
+        assert len(tb.pending) <= LAZY_MAX
+    tb.pop()
+    assert len(tb.line()) < 16 * 4
+
+def random_output(random, length):
+    """
+    Output a repl could plausibly write: runs of characters, CRLFs,
+    backspaces and the escape sequences it uses to move around a line
+    """
+
+    parts = []
+    for i in range(length):
+        kind = random.randrange(10)
+        if kind < 4:
+            parts.append('%c' % random.randrange(97, 123) * random.randrange(1, 80))
+        elif kind == 4:
+            parts.append('\r\n')
+        elif kind == 5:
+            parts.append('\b')
+        elif kind == 6:
+            # not forward, moving past the end pads the line and that can make it too long
+            parts.append('\x1b[%d%c' % (random.randrange(1, 40), random.choice('ABD')))
+        elif kind == 7:
+            parts.append('\x1b[%d;%dH' % (random.randrange(1, 6), random.randrange(1, 20)))
+        elif kind == 8:
+            parts.append(random.choice(['\x1b[K', '\x1b[1K', '\x1b[2K', '\x1b[2J']))
+        else:
+            parts.append('\x1b[1m' * random.randrange(1, 20))
+    return ''.join(parts).encode()
+
+@pytest.mark.parametrize("seed", range(800))
+def test_lazy_matches_eager_fuzzed(seed):
+    import random
+    random = random.Random(seed)
+    eager = TextBuffer(16, 4)
+    lazy = TextBuffer(16, 4, lazy=True)
+    text = random_output(random, random.randrange(1, 60))
+
+    start = 0
+    while start < len(text):
+        end = start + random.randrange(1, 200)
+        for tb in [eager, lazy]:
+            tb.write(text[start:end])
+        start = end
+        if random.randrange(3) == 0:
+            eager.pop()
+            lazy.pop()
+            assert lazy.get_screen_lines() == eager.get_screen_lines()
+            assert (lazy.x(), lazy.y()) == (eager.x(), eager.y())
+
+    eager.pop()
+    lazy.pop()
+    assert lazy.get_screen_lines() == eager.get_screen_lines()
+    assert (lazy.x(), lazy.y()) == (eager.x(), eager.y())
+
+def test_lazy_long_line_after_text():
+    # the long line carries on from text that's already there and ends in escapes
+    screens = []
+    for tb in [TextBuffer(16, 4), TextBuffer(16, 4, lazy=True)]:
+        tb.write(b'x' * 20)
+        tb.pop()
+        tb.write(b'y' * 100 + b'\x1b[1m' * 10)
+        tb.pop()
+        screens.append((tb.get_screen_lines(), tb.x(), tb.y()))
+    assert screens[0] == screens[1] == ([b'y' * 16] * 3 + [b'y' * 8], 8, 3)
@@ -0,0 +1,21 @@
+# micropython's time.ticks_* functions and sleep_ms, with stand-ins on cpython so the modules that use them can be tested there
+try:
+    from time import ticks_ms, ticks_us, ticks_diff, ticks_add, sleep_ms
+except ImportError:
+    import time
+
+    # these don't wrap around like the real ones do, but differences come out the same
+    def ticks_ms():
+        return int(time.monotonic() * 1000)
+
+    def ticks_us():
+        return int(time.monotonic() * 1000000)
+
+    def ticks_diff(ticks1, ticks2):
+        return ticks1 - ticks2
+
+    def ticks_add(ticks, delta):
+        return ticks + delta
+
+    def sleep_ms(ms):
+        time.sleep(ms / 1000)
@@ -28,13 +28,13 @@ class Monitor(IOBase):
         line_dict = self.textbuffer.pop()
         for y in range(self.textbuffer.rows):
             if y in line_dict:
-                lines.append(line_dict[y] + '\n')
+                lines.append(line_dict[y][0].decode() + '\n')
             else:
                 lines.append('*' * self.textbuffer.cols + '\n')
 
         lines.append('\n')
         lines.append(str(self.textbuffer.offset) + '\n')
-        lines.append(self.textbuffer.previous_char + '\n')
+        lines.append(chr(self.textbuffer.previous_char) + '\n')
         lines.append(str(len(line_dict)) + '\n')
 
         with open("screen.txt", 'w') as dumpfile:
@@ -44,13 +44,14 @@ class Monitor(IOBase):
     def dump_lines(self):
         with open("lines.txt", 'w') as dumpfile:
             for line in self.textbuffer.lines:
-                dumpfile.write(line + '\n')
+                dumpfile.write(line.decode() + '\n')
 
     def dump_wrapped(self):
         with open("wrapped.txt", 'w') as dumpfile:
-            for wrapped_lines in self.textbuffer.wrapped:
-                for line in wrapped_lines:
-                    dumpfile.write(line + '\n')
+            wrapped = self.textbuffer.wrapped
+            for index in range(len(wrapped)):
+                for row in range(wrapped.count(index)):
+                    dumpfile.write(wrapped.part(index, row).decode() + '\n')
 
 monitor = Monitor()
 prev = dupterm(monitor, 1)